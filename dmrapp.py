@@ -1,26 +1,46 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import asyncio
 import base64
+import cProfile
 import datetime
 import hashlib
+import hmac
 import io
 import json
+import logging
+import multiprocessing
+import numpy
 import os
 import pandas
 import pathlib
-import pytz
-import soundfile
+import pickle
+import pstats
+import re
+import secrets
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
 
 from calendar import monthrange
-from dateutil import parser, tz
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext, suppress
+from dateutil import tz
 from fastapi import Request
-from fastapi.responses import RedirectResponse
+from fastapi.responses import FileResponse, RedirectResponse, Response, StreamingResponse
 from nicegui import app, ui, Client
-from sqlalchemy import create_engine, exc, text
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.pool import NullPool
 from starlette.middleware.base import BaseHTTPMiddleware
-from threading import Timer
+from threading import Event, Lock, Thread, get_ident, local
 from typing import Optional, Union
+from urllib.parse import quote
 
 # Прероутер для авторизации
 class AuthMiddleware(BaseHTTPMiddleware):
@@ -32,6 +52,137 @@ class AuthMiddleware(BaseHTTPMiddleware):
                 return RedirectResponse('/login')
         return await call_next(request)
 
+# Снимок профиля одного запроса для администратора (параметр ?profile=1)
+class ProfileMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, users: dict) -> None:
+        super().__init__(app)
+        self._users = users
+
+    async def dispatch(self, request: Request, call_next):
+        if 'profile' not in request.query_params or self._users.get(app.storage.user.get('username'), {}).get('role') != 'admin':
+            return await call_next(request)
+
+        # Профилируется поток цикла событий, работа в пулах потоков видна как ожидание
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            response = await call_next(request)
+            async for chunk in response.body_iterator:
+                pass
+        finally:
+            profile.disable()
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(int(request.query_params.get('profile') or 0) or 50)
+        return Response(out.getvalue(), media_type='text/plain; charset=utf-8')
+
+# Таймеры и счетчики операций, журнал медленных запросов и выдача в текстовом формате Prometheus
+class Metrics():
+    def __init__(self, slow: float = 1.0, slowlog: Optional[str] = None) -> None:
+        self._slow = slow
+        self._lock = Lock()
+        self._timers = {}
+        self._counters = {}
+        self._gauges = {}
+        self._local = local()
+        self._log = logging.getLogger('dmrapp.slow')
+        if slowlog:
+            handler = logging.FileHandler(slowlog, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self._log.addHandler(handler)
+            self._log.setLevel(logging.INFO)
+
+    # Замер длительности операции, запросы к БД внутри нее помечаются ее именем
+    @contextmanager
+    def timer(self, op: str):
+        ops = self._local.__dict__.setdefault('ops', [])
+        ops.append(op)
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            ops.pop()
+            self.observe('dmrapp_op_seconds', {'op': op}, time.perf_counter() - begin)
+
+    # Текущая операция потока
+    def current(self) -> str:
+        ops = self._local.__dict__.get('ops', [])
+        return ops[-1] if len(ops) > 0 else 'other'
+
+    # Добавляет наблюдение длительности
+    def observe(self, name: str, labels: dict, value: float) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            item = self._timers.setdefault(key, [0, 0.0, 0.0])
+            item[0] += 1
+            item[1] += value
+            item[2] = max(item[2], value)
+
+    # Увеличивает счетчик
+    def add(self, name: str, labels: dict, value: float = 1) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # Регистрирует показатель, значение которого вычисляется при выдаче
+    def gauge(self, name: str, func) -> None:
+        self._gauges[name] = func
+
+    # Подключает учет времени, строк и медленных запросов к движку SQLAlchemy
+    def attach(self, engine, db: str) -> None:
+        event.listen(engine, 'before_cursor_execute', self._before_query)
+        event.listen(engine, 'after_cursor_execute', lambda conn, cursor, statement, parameters, context, executemany:
+                     self._after_query(db, context, cursor, statement, parameters))
+
+    # Время начала хранится в контексте выполнения, который не переживает запрос, даже завершившийся ошибкой
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        context._dmrapp_started = time.perf_counter()
+
+    def _after_query(self, db: str, context, cursor, statement: str, parameters) -> None:
+        elapsed = time.perf_counter() - context._dmrapp_started
+        labels = {'db': db, 'op': self.current()}
+        self.observe('dmrapp_query_seconds', labels, elapsed)
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            self.add('dmrapp_query_rows_total', labels, cursor.rowcount)
+        if elapsed >= self._slow:
+            self.add('dmrapp_slow_queries_total', labels)
+            self._log.warning('%.3f s db=%s op=%s params=%r sql=%s', elapsed, db, labels['op'], parameters, ' '.join(statement.split()))
+
+    # Подсчитывает байты, переданные потоковым ответом
+    def stream(self, op: str, response: Response) -> Response:
+        if isinstance(response, StreamingResponse):
+            body = response.body_iterator
+
+            async def counted():
+                async for chunk in body:
+                    self.add('dmrapp_sent_bytes_total', {'op': op}, len(chunk))
+                    yield chunk
+            response.body_iterator = counted()
+        return response
+
+    # Все показатели в текстовом формате Prometheus
+    def render(self) -> str:
+        def fmt(name: str, labels: tuple, value) -> str:
+            text = ','.join('{}="{}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, val in labels)
+            return f'{name}{{{text}}} {value}' if text else f'{name} {value}'
+
+        with self._lock:
+            timers = sorted(self._timers.items())
+            counters = sorted(self._counters.items())
+        lines = []
+        for name in sorted({key[0] for key, item in timers}):
+            lines.append(f'# TYPE {name} summary')
+            lines += [fmt(f'{name}_count', key[1], item[0]) for key, item in timers if key[0] == name]
+            lines += [fmt(f'{name}_sum', key[1], round(item[1], 6)) for key, item in timers if key[0] == name]
+            lines.append(f'# TYPE {name}_max gauge')
+            lines += [fmt(f'{name}_max', key[1], round(item[2], 6)) for key, item in timers if key[0] == name]
+        for name in sorted({key[0] for key, value in counters}):
+            lines.append(f'# TYPE {name} counter')
+            lines += [fmt(name, key[1], value) for key, value in counters if key[0] == name]
+        for name, func in sorted(self._gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(fmt(name, (), func()))
+        return '\n'.join(lines) + '\n'
+
 # Роутер страниц приложения
 class UIPage(ui.page):
     def __init__(self) -> None:
@@ -41,10 +192,205 @@ class UIPage(ui.page):
         self._path = path
         self.__call__(func)
 
+# Таблица с постраничной выдачей, сортировкой и фильтрацией на стороне сервера
+class PagedTable():
+    def __init__(self, data: pandas.DataFrame, row_key: str, rows_per_page: int = 50, labels: Optional[dict] = None, search: bool = False,
+                 metrics: Optional[Metrics] = None, sortkeys: Optional[dict] = None, **kwargs) -> None:
+        self._labels = labels or {}
+        # Функции, приводящие отформатированные столбцы к значениям для сортировки
+        self._sortkeys = sortkeys or {}
+        self._metrics = metrics
+        self._pagination = {'page': 1, 'rowsPerPage': rows_per_page, 'sortBy': None, 'descending': False, 'rowsNumber': 0}
+        self.table = ui.table(columns=[], rows=[], row_key=row_key, pagination=self._pagination, **kwargs)
+        self.table.on('request', self._request)
+        if search:
+            with self.table.add_slot('top-right'):
+                ui.input('Поиск', on_change=lambda e: self.set_filter(e.value)).props('dense clearable')
+        self._filter = ''
+        self.set_data(data)
+
+    # Заменяет данные таблицы без пересоздания компонента, rows - позиции отображаемых строк
+    def set_data(self, data: pandas.DataFrame, rows=None) -> None:
+        self._data = data.reset_index(drop=True)
+        self._rows = rows
+        self.table.columns = [{'name': col, 'label': self._labels.get(col, col), 'field': col, 'sortable': True} for col in self._data.columns]
+        self.set_filter(self._filter)
+
+    # Ограничивает таблицу строками с заданными позициями, None - все строки
+    def set_rows(self, rows) -> None:
+        self._rows = rows
+        self.set_filter(self._filter)
+
+    # Отбирает строки, содержащие строку поиска в любом столбце
+    def set_filter(self, text: Optional[str]) -> None:
+        self._filter = (text or '').strip().lower()
+        self._view = self._data if self._rows is None else self._data.take(self._rows)
+        if self._filter != '' and len(self._view) > 0:
+            mask = self._view.astype(str).apply(lambda col: col.str.lower().str.contains(self._filter, regex=False)).any(axis=1)
+            self._view = self._view[mask]
+        self._sorted = None
+        self._pagination['page'] = 1
+        self._show()
+
+    # Запрос страницы из браузера
+    def _request(self, e) -> None:
+        args = e.args[0] if isinstance(e.args, list) else e.args
+        self._pagination.update(args.get('pagination', {}))
+        self._show()
+
+    # Отправляет в браузер только видимую страницу
+    def _show(self) -> None:
+        with self._metrics.timer('table_page') if self._metrics is not None else nullcontext():
+            key = (self._pagination.get('sortBy'), self._pagination.get('descending'))
+            if self._sorted is None or self._sorted[0] != key:
+                view = self._view
+                if key[0] in view.columns:
+                    view = view.sort_values(key[0], ascending=not key[1], kind='stable', key=self._sortkeys.get(key[0]))
+                self._sorted = (key, view)
+            view = self._sorted[1]
+
+            size = self._pagination.get('rowsPerPage') or max(len(view), 1)
+            page = min(max(self._pagination.get('page', 1), 1), max((len(view) + size - 1) // size, 1))
+            chunk = view.iloc[(page - 1) * size:page * size]
+
+            # Страница невелика, поэтому нечисловые значения приводятся к строкам поэлементно
+            chunk = chunk.copy()
+            for col in chunk.columns:
+                if not pandas.api.types.is_numeric_dtype(chunk[col]) or pandas.api.types.is_bool_dtype(chunk[col]):
+                    chunk[col] = pandas.Series([None if pandas.isna(v) else str(v) for v in chunk[col]], index=chunk.index, dtype=object)
+
+            self._pagination.update({'page': page, 'rowsNumber': len(view)})
+            self.table.rows = chunk.to_dict('records')
+            self.table.pagination = dict(self._pagination)
+            self.table.update()
+
+# Фоновые задания выгрузки в файл
+class ExportJobs():
+    def __init__(self, workers: int = 2, keep: int = 3600) -> None:
+        self._dir = tempfile.mkdtemp(prefix='dmrapp-export-')
+        self._keep = keep
+        self._lock = Lock()
+        self._jobs = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dmrexport')
+
+    # Ставит задание в очередь, func(fpath, progress) пишет результат в файл и сообщает долю выполнения
+    def submit(self, owner: str, fname: str, func) -> str:
+        self._cleanup()
+        job = secrets.token_urlsafe(12)
+        fpath = os.path.join(self._dir, f'{job}{pathlib.Path(fname).suffix}')
+        with self._lock:
+            self._jobs[job] = {'owner': owner, 'fname': fname, 'fpath': fpath, 'progress': 0.0, 'done': False, 'error': None, 'created': time.time()}
+        self._executor.submit(self._execute, job, func)
+        return job
+
+    # Состояние задания для его владельца
+    def status(self, job: str, owner: str) -> Optional[dict]:
+        with self._lock:
+            info = self._jobs.get(job)
+            if info is None or info['owner'] != owner:
+                return None
+            return {'progress': info['progress'], 'done': info['done'], 'error': info['error']}
+
+    # Путь и имя готового файла для его владельца
+    def result(self, job: str, owner: str) -> Optional[tuple]:
+        with self._lock:
+            info = self._jobs.get(job)
+            if info is None or info['owner'] != owner or not info['done'] or info['error'] is not None:
+                return None
+            return info['fpath'], info['fname']
+
+    def _execute(self, job: str, func) -> None:
+        def progress(value: float) -> None:
+            with self._lock:
+                self._jobs[job]['progress'] = value
+
+        try:
+            func(self._jobs[job]['fpath'], progress)
+        except Exception as err:
+            with self._lock:
+                self._jobs[job]['error'] = str(err)
+        with self._lock:
+            self._jobs[job]['done'] = True
+
+    # Удаляет устаревшие задания и их файлы
+    def _cleanup(self) -> None:
+        with self._lock:
+            old = [job for job, info in self._jobs.items() if info['done'] and time.time() - info['created'] > self._keep]
+            for job in old:
+                try:
+                    os.remove(self._jobs.pop(job)['fpath'])
+                except OSError:
+                    pass
+
+# Общее для процессов приложения хранилище значений со сроком жизни
+class SharedStore():
+    def __init__(self, fpath: str) -> None:
+        self._lock = Lock()
+        self._db = sqlite3.connect(fpath, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            # В режиме WAL чтение из других процессов не блокируется записью
+            self._db.execute('pragma journal_mode=wal;')
+            self._db.execute('create table if not exists shared (name text primary key, value blob not null, expires real);')
+
+    # Возвращает значение или None, если оно отсутствует или устарело
+    def get(self, name: str):
+        with self._lock:
+            row = self._db.execute('select value from shared where name = ? and (expires is null or expires > ?);', (name, time.time())).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    # Сохраняет значение на ttl секунд, без ttl - бессрочно
+    def set(self, name: str, value, ttl: Optional[float] = None) -> None:
+        with self._lock, self._db:
+            self._db.execute('insert or replace into shared values (?, ?, ?);',
+                             (name, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl if ttl is not None else None))
+
+    # Сохраняет бессрочное значение, если его еще нет, и возвращает действующее
+    def setdefault(self, name: str, value):
+        with self._lock, self._db:
+            self._db.execute('insert or ignore into shared values (?, ?, null);', (name, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        return self.get(name)
+
+    # Удаляет значения по шаблону имени (LIKE)
+    def delete(self, pattern: str) -> None:
+        with self._lock, self._db:
+            self._db.execute('delete from shared where name like ?;', (pattern,))
+
+    # Удаляет устаревшие значения
+    def purge(self) -> None:
+        with self._lock, self._db:
+            self._db.execute('delete from shared where expires < ?;', (time.time(),))
+
+# Реестр краткосрочных подписанных ссылок на аудиозаписи, общий для процессов приложения
+class MediaTokens():
+    def __init__(self, store: SharedStore, ttl: int = 3600) -> None:
+        self._store = store
+        self._ttl = ttl
+        # Ключ подписи создается первым процессом и далее используется всеми
+        self._key = store.setdefault('media:key', secrets.token_bytes(32))
+
+    # Выдает ссылку на файл для пользователя
+    def issue(self, fpath: str, user: str) -> str:
+        nonce = secrets.token_urlsafe(12)
+        expires = time.time() + self._ttl
+        self._store.set(f'media:{nonce}', (fpath, expires), self._ttl)
+        return f'{nonce}.{self._sign(nonce, user, expires)}'
+
+    # Возвращает путь к файлу по ссылке или None, если ссылка недействительна
+    def resolve(self, token: str, user: str) -> Optional[str]:
+        nonce, _, sign = token.partition('.')
+        fpath, expires = self._store.get(f'media:{nonce}') or (None, 0.0)
+        if fpath is None or expires < time.time() or not hmac.compare_digest(sign, self._sign(nonce, user, expires)):
+            return None
+        return fpath
+
+    def _sign(self, nonce: str, user: str, expires: float) -> str:
+        return hmac.new(self._key, f'{nonce}|{user}|{expires}'.encode(), hashlib.sha256).hexdigest()[:32]
+
 # Источник звука для плеера
 class SndSource():
-    def __init__(self, fpath: str) -> None:
+    def __init__(self, fpath: str, tokens: Optional[MediaTokens] = None) -> None:
         self._basedir = os.path.dirname(os.path.abspath(__file__))
+        self._tokens = tokens
         self.set_source(fpath)
 
     @property
@@ -56,55 +402,741 @@ class SndSource():
         return self._uri
 
     def set_source(self, fpath: str) -> str:
-        def remove_old_media_routes(path: str) -> None:
-            app.routes[:] = [r for r in app.routes if not getattr(r, 'path', None).startswith(path)]
-
         if fpath == '':
             self._fpath = ''
             self._uri = ''
         else:
-            self._fpath = fpath.replace('/','\\')
+            self._fpath = fpath
+            self._uri = f'/media/{self._tokens.issue(fpath, app.storage.browser["id"])}'
+
+# Потоковая выдача аудиозаписи: WAV отдается с диска, остальные форматы перекодируются поблочно
+class AudioStream():
+    def __init__(self, fpath: str, blocksize: int = 65536) -> None:
+        self._fpath = fpath
+        self._blocksize = blocksize
+        # Библиотека звука загружается при первом обращении к аудиозаписи
+        import soundfile
+        self._info = soundfile.info(fpath)
+
+    # Признак выдачи файла без перекодирования
+    @property
+    def passthrough(self) -> bool:
+        return self._info.format == 'WAV'
+
+    # Формирует HTTP-ответ с аудиозаписью
+    def response(self, request: Request, fname: str, attachment: bool = True) -> Response:
+        headers = {'Content-Disposition': f"{'attachment' if attachment else 'inline'}; filename*=UTF-8''{quote(fname)}"}
+        if self.passthrough:
+            return self._file_response(request, headers)
+        return StreamingResponse(self._transcode(), media_type='audio/wav', headers=headers)
+
+    # Отдает файл с диска с поддержкой запросов Range
+    def _file_response(self, request: Request, headers: dict) -> Response:
+        size = os.path.getsize(self._fpath)
+        start, end, status = 0, size - 1, 200
+        rng = re.fullmatch(r'bytes=(\d*)-(\d*)', request.headers.get('range', '').strip())
+        if rng and (rng[1] or rng[2]):
+            if rng[1]:
+                start, end = int(rng[1]), min(int(rng[2]) if rng[2] else size - 1, size - 1)
+            else:
+                start = max(size - int(rng[2]), 0)
+            if start > end:
+                return Response(status_code=416, headers={'Content-Range': f'bytes */{size}'})
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers.update({'Accept-Ranges': 'bytes', 'Content-Length': str(end - start + 1)})
+        return StreamingResponse(self._read(start, end - start + 1), status_code=status, media_type='audio/wav', headers=headers)
+
+    # Читает участок файла блоками
+    def _read(self, offset: int, length: int):
+        with open(self._fpath, 'rb') as fl:
+            fl.seek(offset)
+            while length > 0:
+                chunk = fl.read(min(length, self._blocksize))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+
+    # Перекодирует запись в WAV PCM 16 бит блоками постоянного размера
+    def _transcode(self):
+        channels, samplerate = self._info.channels, self._info.samplerate
+        datalen = self._info.frames * channels * 2
+        yield struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + datalen, b'WAVE', b'fmt ', 16, 1, channels, samplerate,
+                          samplerate * channels * 2, channels * 2, 16, b'data', datalen)
+        import soundfile
+        for block in soundfile.blocks(self._fpath, blocksize=self._blocksize, dtype='int16'):
+            yield block.astype('<i2', copy=False).tobytes()
+
+# Дисковый кэш перекодированных аудиозаписей с вытеснением давно не используемых
+class AudioCache():
+    def __init__(self, cachedir: str, budget: int, enabled: bool = True) -> None:
+        self._dir = cachedir
+        self._budget = budget
+        self._enabled = enabled
+        self._lock = Lock()
+        self._locks = {}
+        self._files = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+
+        # Восстанавливаем содержимое кэша, порядок использования берем по времени изменения
+        os.makedirs(cachedir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(cachedir):
+            # Незавершенные файлы удаляются, если их уже не дописывает другой процесс
+            if entry.is_file() and entry.name.endswith('.tmp') and entry.stat().st_mtime < time.time() - 3600:
+                os.remove(entry.path)
+            elif entry.is_file() and entry.name.endswith('.wav'):
+                entries.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+        for mtime, name, size in sorted(entries):
+            self._files[name] = size
+            self._size += size
+
+    # Счетчики обращений и заполненность кэша
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'files': len(self._files), 'bytes': self._size, 'budget': self._budget}
+
+    # Возвращает путь к файлу WAV для воспроизведения и выгрузки, при необходимости перекодируя запись
+    def get(self, fpath: str) -> str:
+        import soundfile
+        if not self._enabled or soundfile.info(fpath).format == 'WAV':
+            return fpath
+
+        name = hashlib.sha256(f'{fpath}|{os.stat(fpath).st_mtime_ns}|WAV'.encode()).hexdigest() + '.wav'
+        cpath = os.path.join(self._dir, name)
+        with self._lock:
+            klock = self._locks.setdefault(name, Lock())
+
+        with klock:
+            try:
+                with self._lock:
+                    # Файл мог быть перекодирован другим процессом приложения
+                    hit = os.path.exists(cpath)
+                    if hit:
+                        if name not in self._files:
+                            self._files[name] = os.path.getsize(cpath)
+                            self._size += self._files[name]
+                        self._files.move_to_end(name)
+                        self._hits += 1
+                if hit:
+                    os.utime(cpath)
+                    return cpath
+
+                self._transcode(fpath, cpath)
+                with self._lock:
+                    self._misses += 1
+                    self._size += os.path.getsize(cpath) - self._files.get(name, 0)
+                    self._files[name] = os.path.getsize(cpath)
+                    self._evict(name)
+            finally:
+                with self._lock:
+                    self._locks.pop(name, None)
+        return cpath
+
+    # Перекодирует запись во временный файл и переносит его в кэш
+    def _transcode(self, fpath: str, cpath: str) -> None:
+        import soundfile
+        tmp = f'{cpath}.{os.getpid()}.{get_ident()}.tmp'
+        info = soundfile.info(fpath)
+        with soundfile.SoundFile(tmp, 'w', info.samplerate, info.channels, 'PCM_16', format='WAV') as out:
+            for block in soundfile.blocks(fpath, blocksize=65536, dtype='int16'):
+                out.write(block)
+        os.replace(tmp, cpath)
+
+    # Удаляет давно не использованные файлы сверх бюджета
+    def _evict(self, keep: str) -> None:
+        while self._size > self._budget and len(self._files) > 1:
+            name, size = next(iter(self._files.items()))
+            if name == keep:
+                self._files.move_to_end(name)
+                continue
+            self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self._dir, name))
+            except OSError:
+                pass
+
+# Индекс аудиозаписей: длительность, уровни и эскиз осциллограммы, вычисляются в фоне
+class AudioIndex():
+    _bars = '▁▂▃▄▅▆▇█'
+
+    def __init__(self, fpath: str, recdir: str, workers: int = 2, points: int = 100, silence: float = 0.001) -> None:
+        self._recdir = recdir
+        self._workers = workers
+        self._points = points
+        self._silence = silence
+        self._lock = Lock()
+        self._db = sqlite3.connect(fpath, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('create table if not exists audioindex (path text primary key, mtime integer not null, duration real, samplerate integer, channels integer, peak real, rms real, wave blob, status text not null, error text);')
+
+    # Анализ одного файла, выполняется в отдельном процессе
+    @staticmethod
+    def analyze(fpath: str, points: int, silence: float) -> dict:
+        import soundfile
+        try:
+            info = soundfile.info(fpath)
+            size = max((info.frames + points - 1) // points, 1)
+            peaks, total, peak = [], 0.0, 0.0
+            for block in soundfile.blocks(fpath, blocksize=size, dtype='float32', always_2d=True):
+                block = numpy.abs(block)
+                peaks.append(float(block.max()) if block.size > 0 else 0.0)
+                total += float(numpy.square(block, dtype='float64').sum())
+                peak = max(peak, peaks[-1])
+            rms = (total / max(info.frames * info.channels, 1)) ** 0.5
+            wave = bytes(min(int(p / peak * 255), 255) if peak > 0 else 0 for p in peaks)
+            return {'duration': info.frames / info.samplerate, 'samplerate': info.samplerate, 'channels': info.channels, 'peak': peak, 'rms': rms,
+                    'wave': wave, 'status': 'silent' if peak < silence else 'ok', 'error': None}
+        except (RuntimeError, OSError, ValueError, ZeroDivisionError) as err:
+            return {'duration': None, 'samplerate': None, 'channels': None, 'peak': None, 'rms': None, 'wave': None, 'status': 'corrupt', 'error': str(err)}
+
+    # Обходит каталог записей и анализирует новые и измененные файлы в пуле процессов
+    def scan(self) -> int:
+        import soundfile
+        exts = {ext.lower() for ext in soundfile.available_formats()}
+        found = {}
+        for root, dirs, files in os.walk(self._recdir):
+            for name in files:
+                if pathlib.Path(name).suffix[1:].lower() in exts:
+                    fpath = os.path.join(root, name)
+                    try:
+                        found[self.key(os.path.relpath(fpath, self._recdir))] = os.stat(fpath).st_mtime_ns
+                    except OSError:
+                        pass
+
+        with self._lock:
+            known = dict(self._db.execute('select path, mtime from audioindex;').fetchall())
+            with self._db:
+                self._db.executemany('delete from audioindex where path = ?;', [(path,) for path in known if path not in found])
+        todo = [path for path, mtime in found.items() if known.get(path) != mtime]
+        if len(todo) == 0:
+            return 0
+
+        # Процессы порождаются заново, чтобы не копировать потоки и соединения приложения
+        with ProcessPoolExecutor(max_workers=self._workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = pool.map(self.analyze, [os.path.join(self._recdir, path) for path in todo],
+                               [self._points] * len(todo), [self._silence] * len(todo), chunksize=16)
+            for path, res in zip(todo, results):
+                with self._lock, self._db:
+                    self._db.execute('insert or replace into audioindex values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                                     (path, found[path], res['duration'], res['samplerate'], res['channels'], res['peak'], res['rms'], res['wave'], res['status'], res['error']))
+        return len(todo)
+
+    # Ключ записи в индексе: путь относительно каталога записей с разделителем '/', без учета регистра в Windows
+    @staticmethod
+    def key(path: str) -> str:
+        return pathlib.PurePath(os.path.normcase(path)).as_posix().lstrip('/')
+
+    # Сведения по списку записей (пути относительно каталога записей), отсутствующие в индексе пропускаются
+    def lookup(self, paths: list) -> dict:
+        res = {}
+        paths = list(dict.fromkeys(self.key(path) for path in paths))
+        for i in range(0, len(paths), 500):
+            part = paths[i:i + 500]
+            with self._lock:
+                rows = self._db.execute(f'select path, duration, wave, status from audioindex where path in ({", ".join("?" * len(part))});', part).fetchall()
+            for path, duration, wave, status in rows:
+                res[path] = {'duration': duration, 'wave': wave, 'status': status}
+        return res
+
+    # Эскиз осциллограммы в виде строки символов заданной ширины
+    @classmethod
+    def sparkline(cls, wave: Optional[bytes], width: int = 24) -> str:
+        if not wave:
+            return ''
+        step = len(wave) / min(width, len(wave))
+        return ''.join(cls._bars[max(wave[int(i * step):max(int((i + 1) * step), int(i * step) + 1)]) * len(cls._bars) // 256]
+                       for i in range(min(width, len(wave))))
+
+# Ошибка обращения к недоступной БД
+class BackendDown(Exception):
+    def __init__(self, title: str, error: Optional[str] = None) -> None:
+        super().__init__(f'База данных {title} недоступна')
+        self.title = title
+        self.error = error
+
+# Наблюдение за доступностью БД и запуск периодических задач из одного фонового потока
+class HealthMonitor():
+    def __init__(self, interval: int = 30, retry: int = 5, workers: int = 2, timeout: int = 5) -> None:
+        self._interval = interval
+        self._retry = retry
+        self._timeout = timeout
+        self._log = logging.getLogger('dmrapp.health')
+        self._lock = Lock()
+        self._wake = Event()
+        self._engines = {}
+        self._probes = {}
+        self._state = {}
+        self._jobs = []
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dmrjob')
+        self._thread = Thread(target=self._loop, name='dmrhealth', daemon=True)
+
+    # Добавляет БД под наблюдение, обрыв соединения при запросе вызывает внеочередную проверку
+    def watch(self, name: str, title: str, engine) -> None:
+        self._engines[name] = engine
+        # Проверка идет отдельным подключением вне пула, чтобы занятый пул не задерживал наблюдение
+        self._probes[name] = create_engine(engine.url, poolclass=NullPool, connect_args={'connect_timeout': self._timeout})
+        self._state[name] = {'title': title, 'up': True, 'latency': None, 'error': None, 'checked': float('-inf'), 'since': time.time()}
+        event.listen(engine, 'handle_error', lambda ctx: self._failed(name, ctx))
+
+    # Добавляет периодическую задачу, которая пропускается, пока недоступна нужная ей БД
+    def every(self, interval: int, func, needs: tuple = (), delay: Optional[int] = None) -> None:
+        with self._lock:
+            self._jobs.append({'interval': interval, 'func': func, 'needs': needs, 'next': time.monotonic() + (interval if delay is None else delay), 'future': None})
+        self._wake.set()
+
+    def start(self) -> None:
+        self._thread.start()
 
-            user = hashlib.sha256(app.storage.browser['id'].encode()).hexdigest()[:32]
-            fl = str(pathlib.Path(self._fpath).stem)
+    # Подключение из пула, если БД доступна, иначе сразу исключение
+    def connect(self, name: str):
+        with self._lock:
+            state = self._state[name]
+            if not state['up']:
+                raise BackendDown(state['title'], state['error'])
+        return self._engines[name].connect()
+
+    # Состояние и задержка ответа каждой БД
+    @property
+    def status(self) -> dict:
+        with self._lock:
+            return {name: dict(state) for name, state in self._state.items()}
+
+    # Обрыв одного подключения не означает недоступность БД: она сразу перепроверяется отдельным подключением
+    def _failed(self, name: str, ctx) -> None:
+        if ctx.is_disconnect:
+            with self._lock:
+                self._state[name]['checked'] = float('-inf')
+            self._wake.set()
+
+    def _mark(self, name: str, up: bool, error: Optional[str] = None, latency: Optional[float] = None) -> None:
+        with self._lock:
+            state = self._state[name]
+            if state['up'] != up:
+                state['since'] = time.time()
+            state.update({'up': up, 'error': error, 'latency': latency, 'checked': time.monotonic()})
+
+    # Проверка БД; при ошибке пул очищается, чтобы после восстановления не выдавать разорванные подключения
+    def _probe(self, name: str) -> None:
+        begin = time.perf_counter()
+        try:
+            with self._probes[name].connect() as conn:
+                conn.execute(text('select 1;'))
+            self._mark(name, True, latency=time.perf_counter() - begin)
+        except Exception as err:
+            self._engines[name].dispose()
+            self._mark(name, False, str(getattr(err, 'orig', None) or err))
+
+    # Выполняет периодическую задачу, ошибка записывается в журнал и не мешает следующим запускам
+    def _execute(self, func) -> None:
+        try:
+            func()
+        except Exception:
+            self._log.exception('periodic job %s failed', getattr(func, '__name__', func))
+
+    def _loop(self) -> None:
+        while True:
+            wait = self._retry
+            try:
+                now = time.monotonic()
+                for name, state in self.status.items():
+                    if now - state['checked'] >= (self._interval if state['up'] else self._retry):
+                        self._probe(name)
+
+                states = self.status
+                with self._lock:
+                    for job in self._jobs:
+                        if job['next'] > now or (job['future'] is not None and not job['future'].done()):
+                            continue
+                        job['next'] = now + job['interval']
+                        if all(states[name]['up'] for name in job['needs']):
+                            job['future'] = self._executor.submit(self._execute, job['func'])
+                    wait = min([self._retry] + [job['next'] - now for job in self._jobs])
+            except Exception:
+                self._log.exception('health monitor iteration failed')
+
+            self._wake.wait(max(wait, 0.5))
+            self._wake.clear()
+
+# Кэш справочников радиостанций и групп, общий для процессов приложения
+class DirCache():
+    def __init__(self, store: SharedStore, probe, load, ttl: int = 300, maxage: int = 3600) -> None:
+        self._store = store
+        self._probe = probe
+        self._load = load
+        self._ttl = ttl
+        self._maxage = maxage
+        self._lock = Lock()
+        self.invalidate()
 
-            remove_old_media_routes(f'/media/{user}/')
-            self._uri = app.add_media_file(local_file=self._fpath, url_path=f'/media/{user}/{fl}')
+    @property
+    def users(self) -> dict:
+        return self._get()[0]
+
+    @property
+    def groups(self) -> dict:
+        return self._get()[1]
+
+    # Названия групп по алфавиту
+    @property
+    def names(self) -> list:
+        return self._get()[2]
+
+    # Время загрузки действующих справочников, меняется при их перечитывании
+    @property
+    def version(self) -> float:
+        self._get()
+        return self._loaded
+
+    # Сбрасывает кэш, следующее обращение перечитает справочники
+    def invalidate(self) -> None:
+        with self._lock:
+            self._store.delete('dirs')
+            self._data = ({}, {}, [])
+            self._stamp = None
+            self._loaded = 0.0
+            self._checked = 0.0
+
+    # Возвращает справочники, при необходимости перечитывая их из БД
+    def _get(self) -> tuple:
+        with self._lock:
+            now = time.time()
+            if self._stamp is not None and now - self._checked < self._ttl:
+                return self._data
+            # Справочники, недавно проверенные другим процессом, берутся из общего хранилища
+            shared = self._store.get('dirs')
+            if shared is not None and now - shared[3] < self._ttl:
+                self._data, self._stamp, self._loaded, self._checked = shared
+                return self._data
+            stamp = self._probe()
+            if shared is not None and shared[1] == stamp and now - shared[2] < self._maxage:
+                self._data, self._stamp, self._loaded = shared[:3]
+            elif stamp != self._stamp or now - self._loaded >= self._maxage:
+                self._data = self._load()
+                self._stamp = stamp
+                self._loaded = now
+            self._checked = now
+            self._store.set('dirs', (self._data, self._stamp, self._loaded, self._checked))
+            return self._data
+
+# Кэш данных за месяц: закрытые месяцы хранятся до вытеснения, незакрытые - не дольше ttl
+class MonthCache():
+    def __init__(self, load, keep: int = 4, ttl: int = 300) -> None:
+        self._load = load
+        self._keep = keep
+        self._ttl = ttl
+        self._lock = Lock()
+        self._locks = {}
+        self._items = OrderedDict()
+
+    # Возвращает данные по ключу, загружая их однократно даже при одновременных запросах
+    def get(self, key: tuple, live: bool):
+        with self._lock:
+            klock = self._locks.setdefault(key, Lock())
+        # Блокировка ключа удаляется после любого исхода, иначе словарь блокировок растет без ограничений
+        with klock:
+            try:
+                with self._lock:
+                    item = self._items.get(key)
+                    if item is not None and (item[1] is None or item[1] > time.monotonic()):
+                        self._items.move_to_end(key)
+                        return item[0]
+                data = self._load(*key)
+                with self._lock:
+                    self._items[key] = (data, time.monotonic() + self._ttl if live else None)
+                    self._items.move_to_end(key)
+                    while len(self._items) > self._keep:
+                        self._items.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._locks.pop(key, None)
+        return data
+
+    # Возвращает уже загруженные данные по ключу или None, не загружая их
+    def peek(self, key: tuple):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and (item[1] is None or item[1] > time.monotonic()):
+                self._items.move_to_end(key)
+                return item[0]
+        return None
+
+    # Сбрасывает сохраненные данные, при live - только данные незакрытых месяцев
+    def invalidate(self, live: bool = False) -> None:
+        with self._lock:
+            for key in [key for key, item in self._items.items() if not live or item[1] is not None]:
+                del self._items[key]
+
+# Каталог недельных таблиц rptbiz с охватываемыми ими периодами
+class TableCatalog():
+    def __init__(self, fpath: str) -> None:
+        self._lock = Lock()
+        self._db = sqlite3.connect(fpath, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('create table if not exists catalog (tname text primary key, minstart text, maxstart text, closed integer not null, updated real not null);')
+
+    # Признак закрытой недели, таблица которой больше не пополняется
+    # Неделя закрывается через grace секунд после окончания, чтобы успели записаться звонки, начатые в конце воскресенья
+    grace = 3600
+
+    @classmethod
+    def closed(cls, tname: str, now: Optional[datetime.datetime] = None) -> bool:
+        now = now or datetime.datetime.now()
+        year, week = int(tname[6:10]), int(tname[10:12])
+        try:
+            end = datetime.datetime.combine(datetime.date.fromisocalendar(year, week, 7), datetime.time()) + datetime.timedelta(days=1)
+        except ValueError:
+            end = datetime.datetime(year + 1, 1, 1)
+        return end + datetime.timedelta(seconds=cls.grace) < now
+
+    # Добавляет новые таблицы и обновляет границы незакрытых недель
+    def refresh(self, conn) -> None:
+        tnames = conn.execute(text('show tables like \'rptbiz%\';'))
+        tnames = [tname for tname, in tnames.fetchall() if re.fullmatch(r'rptbiz\d{6}', tname)]
+        with self._lock:
+            done = {row[0] for row in self._db.execute('select tname from catalog where closed = 1;')}
+        for tname in tnames:
+            if tname in done:
+                continue
+            bounds = conn.execute(text(f'select min(starttime), max(starttime) from {tname};')).fetchone()
+            bounds = [b.strftime('%Y-%m-%d %H:%M:%S') if b is not None else None for b in bounds]
+            with self._lock, self._db:
+                self._db.execute('insert or replace into catalog values (?, ?, ?, ?, ?);', (tname, *bounds, int(self.closed(tname)), time.time()))
+        with self._lock, self._db:
+            self._db.execute(f'delete from catalog where tname not in ({", ".join("?" * len(tnames))});', tnames)
+
+    # Возвращает имена всех известных таблиц
+    def names(self) -> list:
+        with self._lock:
+            return [row[0] for row in self._db.execute('select tname from catalog order by tname;')]
+
+    # Возвращает список пар (год, месяц), за которые есть данные
+    def periods(self) -> list:
+        with self._lock:
+            rows = self._db.execute('select minstart, maxstart from catalog where minstart is not null;').fetchall()
+        res = set()
+        for minstart, maxstart in rows:
+            year, month = int(minstart[0:4]), int(minstart[5:7])
+            while (year, month) <= (int(maxstart[0:4]), int(maxstart[5:7])):
+                res.add((year, month))
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return sorted(res)
+
+    # Возвращает список лет, за которые есть данные
+    def years(self) -> list:
+        return sorted({year for year, month in self.periods()})
+
+    # Возвращает список месяцев указанного года, за которые есть данные
+    def months(self, year: int) -> list:
+        return [month for y, month in self.periods() if y == year]
+
+    # Возвращает таблицы, содержащие данные за указанный месяц
+    def tables(self, year: int, month: int) -> list:
+        fdm = datetime.datetime(year, month, 1, 0, 0, 0)
+        ldm = datetime.datetime(year, month, monthrange(year, month)[1], 23, 59, 59)
+        with self._lock:
+            rows = self._db.execute('select tname from catalog where minstart <= ? and maxstart >= ? order by tname;',
+                                    (ldm.strftime('%Y-%m-%d %H:%M:%S'), fdm.strftime('%Y-%m-%d %H:%M:%S')))
+            return [row[0] for row in rows]
+
+# Локальное хранилище суточных итогов по недельным таблицам rptbiz
+class StatRollup():
+    def __init__(self, fpath: str) -> None:
+        self._lock = Lock()
+        self._db = sqlite3.connect(fpath, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('create table if not exists rollup_tables (tname text primary key, closed integer not null, updated real not null);')
+            self._db.execute('create table if not exists rollup_daily (tname text not null, day text not null, senderid integer not null, sum integer not null, len integer not null, primary key (tname, day, senderid));')
+
+    # Возвращает список таблиц с окончательными итогами
+    def closed_tables(self) -> set:
+        with self._lock:
+            return {row[0] for row in self._db.execute('select tname from rollup_tables where closed = 1;')}
+
+    # Пересчитывает суточные итоги по одной недельной таблице
+    def load_table(self, conn, tname: str) -> None:
+        rows = conn.execute(text(f'select date(starttime), senderid, sum(duration), count(*) from {tname} where (`senderid` between 1000 and 9999) and `calltype`=1 group by date(starttime), senderid;'))
+        rows = [(tname, str(row[0]), int(row[1]), int(row[2]), int(row[3])) for row in rows.fetchall()]
+        with self._lock, self._db:
+            self._db.execute('delete from rollup_daily where tname = ?;', (tname,))
+            self._db.executemany('insert into rollup_daily values (?, ?, ?, ?, ?);', rows)
+            self._db.execute('insert or replace into rollup_tables values (?, ?, ?);', (tname, int(TableCatalog.closed(tname)), time.time()))
+
+    # Догружает закрытые недели; итоги незакрытых берутся из MySQL при запросе, поэтому здесь не считаются
+    def sync(self, conn, tnames: list) -> None:
+        done = self.closed_tables()
+        for tname in tnames:
+            if tname not in done and TableCatalog.closed(tname):
+                self.load_table(conn, tname)
+
+    # Перестраивает хранилище с нуля
+    def rebuild(self, conn, tnames: list) -> None:
+        with self._lock, self._db:
+            self._db.execute('delete from rollup_daily;')
+            self._db.execute('delete from rollup_tables;')
+        self.sync(conn, tnames)
+
+    # Возвращает итоги по радиостанциям за период по указанным таблицам
+    def get_stat(self, tnames: list, fday: datetime.date, lday: datetime.date) -> pandas.DataFrame:
+        marks = ', '.join('?' * len(tnames))
+        with self._lock:
+            rows = self._db.execute(f'select senderid, sum(sum), sum(len) from rollup_daily where tname in ({marks}) and day between ? and ? group by senderid;',
+                                    (*tnames, fday.isoformat(), lday.isoformat())).fetchall()
+        return pandas.DataFrame(rows, columns=['senderid', 'sum', 'len'])
+
+# Состояние страницы отдельного клиента: его данные, элементы управления и плеер
+class ClientState():
+    def __init__(self, username: str, role: str, media: MediaTokens) -> None:
+        self.username = username
+        self.role = role
+        self.sdata = pandas.DataFrame([])
+        self.sindex = {}
+        self.zdata = pandas.DataFrame([])
+        self.zloaded = False
+        self.zcursor = None
+        self.lloaded = False
+        self.lload = None
+        # Выбранная запись и источник плеера хранятся для каждой страницы отдельно
+        self.record = ''
+        self.media = ''
+        self.sndfile = SndSource('', media)
 
 # Основное приложение
 class DMRApp():
     #region Поля
-    _sdata = pandas.DataFrame([])
-    _zdata = pandas.DataFrame([])
-    _sndfile = SndSource('')
     _ui = ui
     #region
 
     #region Конструктор
-    def __init__(self, pgconnstr: str, myconnstr: str, users: dict, recdir: str) -> None:
+    def __init__(self, pgconnstr: str, myconnstr: str, users: dict, recdir: str, options: Optional[dict] = None, primary: bool = True) -> None:
         # Инициализация
         app.add_middleware(AuthMiddleware)
+        app.add_middleware(ProfileMiddleware, users=users)
 
         # Настраиваем маршруты
         self._router = UIPage()
         self._router.add('/', self._uipg_main)
         self._router.add('/login', self._uipg_login)
+        app.add_api_route('/download/audio/{token}', self._rt_audio, methods=['GET'])
+        app.add_api_route('/status/audiocache', self._rt_audiocache, methods=['GET'])
+        app.add_api_route('/status/health', self._rt_health, methods=['GET'])
+        app.add_api_route('/media/{token}', self._rt_media, methods=['GET'])
+        app.add_api_route('/download/export/{job}', self._rt_export, methods=['GET'])
+        app.add_api_route('/stat/load', self._rt_load, methods=['GET'])
+        app.add_api_route('/metrics', self._rt_metrics, methods=['GET'])
+        app.add_api_route('/status/ready', self._rt_ready, methods=['GET'])
 
         # Заполняем поля
         self._users = users
         self._recdir = recdir
-        self._role = "user"
-
-        # Подключаемся к БД
-        self._pgsql = create_engine(pgconnstr, pool_pre_ping=True).connect()
-        self._mysql = create_engine(myconnstr, pool_pre_ping=True).connect()
-
-        self._repeater(300, self._db_mysql_keepalive)
+        self._options = options or {}
+        self._tz = tz.gettz(self._options.get('timezone', 'GMT+7'))
+        self._rows_per_page = self._options.get('tables', {}).get('rows', 50)
+        self._records_page = self._options.get('records', {}).get('page', 1000)
+
+        # Пул рабочих потоков для запросов к БД и обработки данных вне цикла событий UI
+        self._executor = ThreadPoolExecutor(max_workers=self._options.get('workers', 8), thread_name_prefix='dmrapp')
+
+        # Замеры операций и запросов к БД
+        mopts = self._options.get('metrics', {})
+        self._metrics = Metrics(mopts.get('slow', 1.0), os.path.join(os.path.dirname(os.path.abspath(__file__)), mopts['slowlog']) if mopts.get('slowlog') else None)
+        self._metrics_allow = set(mopts.get('allow', ['127.0.0.1', '::1']))
+
+        # Пулы подключений к БД, подключение берется из пула на время операции и заменяется новым по истечении recycle секунд
+        popts = self._options.get('pool', {})
+        popts = {'pool_size': popts.get('size', 5), 'max_overflow': popts.get('overflow', 10), 'pool_timeout': popts.get('timeout', 30), 'pool_recycle': popts.get('recycle', 1800)}
+        self._pgsql = create_engine(pgconnstr, **popts)
+        self._mysql = create_engine(myconnstr, **popts)
+        self._metrics.attach(self._pgsql, 'pgsql')
+        self._metrics.attach(self._mysql, 'mysql')
+
+        # Наблюдение за доступностью БД и периодические задачи
+        hopts = self._options.get('health', {})
+        self._health = HealthMonitor(hopts.get('interval', 30), hopts.get('retry', 5), hopts.get('workers', 2), hopts.get('timeout', 5))
+        self._health.watch('pgsql', 'Такт ПРО', self._pgsql)
+        self._health.watch('mysql', 'XNMS', self._mysql)
+        for name in ('pgsql', 'mysql'):
+            self._metrics.gauge(f'dmrapp_{name}_up', lambda name=name: int(self._health.status[name]['up']))
+            self._metrics.gauge(f'dmrapp_{name}_latency_seconds', lambda name=name: round(self._health.status[name]['latency'] or 0, 6))
+        app.add_exception_handler(BackendDown, self._rt_backend_down)
+
+        # Общее для процессов приложения хранилище: итоги, справочники, ссылки на записи
+        localdb = os.path.join(os.path.dirname(os.path.abspath(__file__)), self._options.get('localdb', 'dmrapp.db'))
+        self._shared = SharedStore(localdb)
+
+        # Справочники радиостанций и групп
+        dcopts = self._options.get('dircache', {})
+        self._dircache = DirCache(self._shared, self._db_pgsql_get_dirstamp, lambda: (self._db_pgsql_get_users(), self._db_pgsql_get_groups(), self._db_pgsql_get_group_names()),
+                                  dcopts.get('ttl', 300), dcopts.get('maxage', 3600))
+
+        # Каталог недельных таблиц и локальное хранилище итогов по закрытым неделям
+        self._catalog = TableCatalog(localdb)
+
+        # Звонки за месяц, общие для итогов и подробностей по радиостанции
+        sopts = self._options.get('stat', {})
+        self._calls = MonthCache(self._db_mysql_get_calls, sopts.get('months', 4), sopts.get('ttl', 300))
+        self._loads = MonthCache(self._get_load, 108, sopts.get('ttl', 300))
+
+        # Готовые таблицы статистики по месяцам и ролям; версия справочников в ключе заменяет устаревшие названия
+        self._stats = MonthCache(self._build_stat, sopts.get('results', 24), sopts.get('ttl', 300))
+        self._livestamp = None
+
+        # Пустой каталог заполняется до открытия первой страницы, далее обновляется в фоне
+        # При запуске нескольких процессов фоновые задачи выполняет только основной, остальные читают общие данные
+        self._primary = primary
+        if len(self._catalog.names()) == 0:
+            self._catalog_sync()
+        if primary:
+            self._health.every(self._options.get('catalog', {}).get('refresh', 300), self._catalog_sync, ('mysql',))
+            self._health.every(3600, self._shared.purge)
+        if sopts.get('watch', 60) > 0:
+            self._health.every(sopts.get('watch', 60), self._stat_watch, ('mysql',) if primary else ())
+
+        ropts = self._options.get('rollup', {})
+        self._rollup = None
+        if ropts.get('enabled', True):
+            self._rollup = StatRollup(localdb)
+            if primary:
+                self._health.every(ropts.get('refresh', 300), self._rollup_sync, ('mysql',), 0)
+
+        # Фоновые выгрузки статистики
+        self._exports = ExportJobs(self._options.get('export', {}).get('workers', 2), self._options.get('export', {}).get('keep', 3600))
+
+        # Ссылки на аудиозаписи для плеера
+        self._media = MediaTokens(self._shared, self._options.get('media', {}).get('ttl', 3600))
+
+        # Кэш перекодированных аудиозаписей
+        acopts = self._options.get('audiocache', {})
+        self._audiocache = AudioCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), acopts.get('dir', 'cache')),
+                                      acopts.get('budget', 2 * 1024 ** 3), acopts.get('enabled', True))
+        if primary and acopts.get('enabled', True) and acopts.get('prewarm', 900) > 0:
+            self._health.every(acopts.get('prewarm', 900), self._audio_prewarm, ('pgsql',), 0)
+        for name in ('hits', 'misses', 'files', 'bytes'):
+            self._metrics.gauge(f'dmrapp_audiocache_{name}', lambda name=name: self._audiocache.stats[name])
+
+        # Индекс длительностей и осциллограмм аудиозаписей
+        aiopts = self._options.get('audioindex', {})
+        self._audioindex = None
+        if aiopts.get('enabled', True):
+            self._audioindex = AudioIndex(localdb, recdir, aiopts.get('workers', 2), aiopts.get('points', 100), aiopts.get('silence', 0.001))
+            if primary:
+                self._health.every(aiopts.get('refresh', 3600), self._audio_index, (), 0)
+
+        # Прогрев кэшей после запуска сервера
+        self._warmup = {'ready': False, 'started': None, 'finished': None, 'errors': []}
+        app.on_startup(lambda: self._executor.submit(self._warm))
+
+        self._health.start()
     #endregion
 
     #region Основные методы
     # Запуск приложения
-    def start(self) -> None:
+    def start(self, port: int = 2606) -> None:
         radio = '''
             <svg height="800px" width="800px" version="1.1" id="Layer_1" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" viewBox="0 0 512.001 512.001" xml:space="preserve">
                 <circle style="fill:#FFD2BE;" cx="255.996" cy="146.87" r="146.87"/>
@@ -149,45 +1181,187 @@ class DMRApp():
                     M269.728,426.917l48.99-36.136l26.976,92.17L269.728,426.917z"/>
             </svg>
         '''
-        ui.run(port=2606, title='Радиосвязь DMR', favicon=radio, language='ru', storage_secret='secret', reload=False, show=False)
+        ui.run(port=port, title='Радиосвязь DMR', favicon=radio, language='ru', storage_secret='secret', reload=False, show=False)
 
     # Остановка приложения
     def stop(self) -> None:
         app.shutdown()
 
     # Статистика по радиосвязи
-    def getstat(self, year: int, month: int) -> pandas.DataFrame:
-        data = self._db_mysql_get_stat(year, month)
-        data.insert(1, 'gid', data['senderid'])
-        data['gid'] = data['gid'].map(self._db_pgsql_get_groups())
-        data['sender'] = data['sender'].map(self._db_pgsql_get_users())
-        data = data.rename(columns={'senderid': 'ID радиостанции', 'gid': 'Группа', 'sender': 'Должность', 'sum': 'Общее время', 'len': 'Количество сеансов', 'avg': 'Среднее время'})
-        data = self._filter_recs(data)
+    def getstat(self, year: int, month: int, role: str = 'user') -> pandas.DataFrame:
+        with self._metrics.timer('getstat'):
+            data = self._stats.get((year, month, role, self._dircache.version), self._month_live(year, month)).copy()
+        self._metrics.add('dmrapp_op_rows_total', {'op': 'getstat'}, len(data))
         return data
 
-    def getdetail(self, rid: int, year: int, month: int) -> pandas.DataFrame:
-        data = self._db_mysql_get_detail(rid, year, month)
-        data.insert(1, 'gid', data['senderid'])
-        data['gid'] = data['gid'].map(self._db_pgsql_get_groups())
-        data['sender'] = data['sender'].map(self._db_pgsql_get_users())
-        data['duration'] = data['duration'].div(1000).round(2)
-        data.insert(0, 'id', data.index + 1)
-        data = data.rename(columns={'id': '#', 'senderid': 'ID радиостанции', 'gid': 'Группа', 'sender': 'Должность', 'starttime': 'Начат', 'duration': 'Длительность (c)', 'endtime': 'Завершен'})
-        data = self._filter_recs(data)
+    def getdetail(self, rid: int, year: int, month: int, role: str = 'user') -> pandas.DataFrame:
+        with self._metrics.timer('getdetail'):
+            # Звонки месяца, уже загруженные для нагрузки, используются повторно, иначе запрашиваются звонки одной радиостанции
+            calls = self._calls.peek((year, month))
+            if calls is not None:
+                lo, hi = calls['senderid'].searchsorted(rid, side='left'), calls['senderid'].searchsorted(rid, side='right')
+                data = calls.iloc[lo:hi].reset_index(drop=True)
+            else:
+                data = self._db_mysql_get_calls(year, month, rid)
+            data.insert(1, 'sender', data['senderid'])
+            data.insert(1, 'gid', data['senderid'])
+            data['gid'] = data['gid'].map(self._dircache.groups)
+            data['sender'] = data['sender'].map(self._dircache.users)
+            data['duration'] = data['duration'].div(1000).round(2)
+            data.insert(0, 'id', data.index + 1)
+            data = data.rename(columns={'id': '#', 'senderid': 'ID радиостанции', 'gid': 'Группа', 'sender': 'Должность', 'starttime': 'Начат', 'duration': 'Длительность (c)', 'endtime': 'Завершен'})
+            data = self._filter_recs(data, role)
+        self._metrics.add('dmrapp_op_rows_total', {'op': 'getdetail'}, len(data))
         return data
 
+    # Нагрузка на каналы за месяц или за весь год (month=None): звонки, эфир (ч) и пик одновременных звонков
+    # по дням недели и часам, эфир групп по часам суток
+    def getload(self, year: int, month: Optional[int] = None, role: str = 'user') -> dict:
+        with self._metrics.timer('getload'):
+            months = [month] if month is not None else self._catalog.months(year)
+            version = self._dircache.version
+            parts = [self._loads.get((year, mon, role, version), self._month_live(year, mon)) for mon in months]
+            days = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+            res = {}
+            for name, agg in (('count', numpy.sum), ('airtime', numpy.sum), ('peak', numpy.max)):
+                cells = agg([part[name] for part in parts], axis=0) if len(parts) > 0 else numpy.zeros(168)
+                res[name] = pandas.DataFrame(cells.reshape(7, 24), index=days, columns=range(24))
+            res['airtime'] = res['airtime'].div(3600).round(2)
+
+            senders = pandas.concat([part['senders'] for part in parts]).groupby(level=0).sum() if len(parts) > 0 else pandas.DataFrame([], columns=range(24))
+            groups = senders.groupby(senders.index.map(self._dircache.groups)).sum().div(3600).round(2)
+            groups.columns = [f'{hour:02d}' for hour in groups.columns]
+            groups.insert(0, 'Всего', groups.sum(axis=1).round(2))
+            groups = groups.rename_axis('Группа').reset_index().sort_values('Всего', ascending=False)
+            res['groups'] = self._filter_recs(groups, role).reset_index(drop=True)
+            return res
+
     # Информация по звукозаписи
     def getzz(self, dt: str) -> pandas.DataFrame:
-        rdt = datetime.datetime.strptime(dt, '%d.%m.%Y')
-        data = self._db_pgsql_get_records(rdt.strftime('%Y-%m-%d %H:%M:%S'))
+        data, _ = self.searchzz(f'{dt} 00:00', f'{dt} 23:59')
         return data
+
+    # Поиск звукозаписей за период местного времени ('dd.mm.YYYY HH:MM'), возвращает страницу и ключ для следующей страницы
+    def searchzz(self, dtfrom: str, dtto: str, caller: Optional[int] = None, name: Optional[str] = None, after: Optional[tuple] = None, limit: Optional[int] = None) -> tuple:
+        with self._metrics.timer('searchzz'):
+            dtstart = self._gmt2utc(datetime.datetime.strptime(dtfrom, '%d.%m.%Y %H:%M').strftime('%Y-%m-%d %H:%M:00'))
+            dtend = self._gmt2utc(datetime.datetime.strptime(dtto, '%d.%m.%Y %H:%M').strftime('%Y-%m-%d %H:%M:59'))
+            data, last = self._db_pgsql_get_records(dtstart, dtend, caller, (name or '').strip(), after, limit)
+            if len(data) > 0:
+                data['datetimestart'] = self._utc2gmt(data['datetimestart'])
+                data['datetimeend'] = self._utc2gmt(data['datetimeend'])
+            if self._audioindex is not None:
+                info = self._audioindex.lookup(data['filepath'].tolist())
+                info = {fpath: info.get(AudioIndex.key(fpath), {}) for fpath in data['filepath']}
+                data['duration'] = pandas.to_numeric(data['filepath'].map(lambda fpath: info.get(fpath, {}).get('duration'))).round(1)
+                data['wave'] = data['filepath'].map(lambda fpath: AudioIndex.sparkline(info.get(fpath, {}).get('wave')))
+                data['status'] = data['filepath'].map(lambda fpath: {'silent': 'Тишина', 'corrupt': 'Поврежден'}.get(info.get(fpath, {}).get('status'), ''))
+            data = data.drop(columns='filepath')
+            return data, (last if limit is not None and len(data) == limit else None)
+
+    # Асинхронные варианты, выполняются в пуле рабочих потоков
+    async def agetstat(self, year: int, month: int, role: str = 'user') -> pandas.DataFrame:
+        return await self._run(self.getstat, year, month, role)
+
+    async def agetdetail(self, rid: int, year: int, month: int, role: str = 'user') -> pandas.DataFrame:
+        return await self._run(self.getdetail, rid, year, month, role)
+
+    async def agetload(self, year: int, month: Optional[int] = None, role: str = 'user') -> dict:
+        return await self._run(self.getload, year, month, role)
+
+    async def agetzz(self, dt: str) -> pandas.DataFrame:
+        return await self._run(self.getzz, dt)
+
+    async def asearchzz(self, dtfrom: str, dtto: str, caller: Optional[int] = None, name: Optional[str] = None, after: Optional[tuple] = None, limit: Optional[int] = None) -> tuple:
+        return await self._run(self.searchzz, dtfrom, dtto, caller, name, after, limit)
+
+    # Сброс кэша справочников радиостанций и групп
+    def invalidate_dirs(self) -> None:
+        self._dircache.invalidate()
     #endregion
 
     #region Вспомогательные методы
+    # Выполняет блокирующую операцию в пуле рабочих потоков
+    async def _run(self, func, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        except (BackendDown, exc.DBAPIError) as err:
+            # В обработчиках страницы сообщаем пользователю, в маршрутах API ошибку обработает app
+            with suppress(RuntimeError):
+                ui.notify(str(err) if isinstance(err, BackendDown) else f'Ошибка запроса к БД: {err.orig}', color='negative')
+            raise
+
+    # Формирует таблицу статистики
+    def _stat_table(self, st: ClientState, data: pandas.DataFrame) -> None:
+        with st.cont_t1:
+            st.pt_data = PagedTable(data, 'ID радиостанции', self._rows_per_page, search=True, metrics=self._metrics,
+                                    sortkeys={'Общее время': self._hms2sec, 'Среднее время': self._hms2sec})
+            st.tb_data = st.pt_data.table.classes('w-full')
+            st.tb_data.add_slot('body-cell', r"""
+                <q-td :props="props" @dblclick="$parent.$emit('cell_dblclick', props)">
+                    {{ props.value }}
+                </q-td>
+                """)
+            st.tb_data.on('cell_dblclick', lambda msg: self.detail(st, msg.args.get('row')))
+
+    # Выгружает статистику за несколько месяцев в файл xlsx или csv, не держа в памяти весь отчет
+    def _export_stat(self, fpath: str, progress, periods: list, group: str, bygroups: bool, role: str) -> None:
+        with self._metrics.timer('export'):
+            if fpath.endswith('.csv'):
+                with open(fpath, 'w', encoding='utf-8-sig', newline='') as fl:
+                    for i, (year, month) in enumerate(periods):
+                        data = self._export_frame(year, month, group, role)
+                        data.to_csv(fl, sep=';', index=False, header=(i == 0))
+                        progress((i + 1) / len(periods))
+                return
+
+            # Библиотека Excel загружается только при первой выгрузке
+            from openpyxl import Workbook
+            from openpyxl.utils import get_column_letter
+            wb = Workbook(write_only=True)
+            sheets = {}
+            for i, (year, month) in enumerate(periods):
+                data = self._export_frame(year, month, group, role)
+                parts = data.groupby('Группа', dropna=False, sort=True) if bygroups else [(group, data)]
+                for name, part in parts:
+                    name = 'Без группы' if pandas.isna(name) else str(name)
+                    if name not in sheets:
+                        # В потоковом режиме ширина столбцов задается до первой строки
+                        sheets[name] = wb.create_sheet(re.sub(r'[\[\]:*?/\\]', '_', name)[:31])
+                        for idx, column in enumerate(data.columns):
+                            sheets[name].column_dimensions[get_column_letter(idx + 1)].width = max(len(column), 10) + 3
+                        sheets[name].append(list(data.columns))
+                    for row in part.astype(object).where(part.notna(), None).itertuples(index=False, name=None):
+                        sheets[name].append(row)
+                progress((i + 1) / len(periods))
+            if len(sheets) == 0:
+                wb.create_sheet(group)
+            wb.save(fpath)
+
+    # Индекс групп: позиции строк статистики для каждой группы, строится один раз на выборку
+    def _group_index(self, data: pandas.DataFrame) -> dict:
+        if 'Группа' not in data.columns:
+            return {}
+        return data.reset_index(drop=True).groupby('Группа', sort=False).indices
+
+    # Позиции строк выбранной группы, None - все группы
+    def _group_rows(self, st: ClientState):
+        if st.sl_group.value == 'Все группы':
+            return None
+        return st.sindex.get(st.sl_group.value, [])
+
+    # Статистика за месяц для выгрузки
+    def _export_frame(self, year: int, month: int, group: str, role: str) -> pandas.DataFrame:
+        data = self.getstat(year, month, role)
+        if group != 'Все группы':
+            data = data.take(self._group_index(data).get(group, []))
+        data.insert(0, 'Период', f'{self._num2month(month)} {year}')
+        return data
 
-    def _filter_recs(self, recs: pandas.DataFrame,) -> pandas.DataFrame:
+
+    def _filter_recs(self, recs: pandas.DataFrame, role: str) -> pandas.DataFrame:
         res = recs
-        match self._role:
+        match role:
             case "manager":
                 res = res[res['Группа'] != 'Связисты']
             case "user":
@@ -195,9 +1369,9 @@ class DMRApp():
                 res = res[res['Группа'] != 'Административная']
         return res
 
-    def _filter_groups(self, grps: list) -> list:
-        res = grps
-        match self._role:
+    def _filter_groups(self, grps: list, role: str) -> list:
+        res = list(grps)
+        match role:
             case "manager":
                 res.remove('Связисты')
             case "user":
@@ -205,24 +1379,213 @@ class DMRApp():
                 res.remove('Административная')
         return res
 
-    def _repeater(self, interval, function):
-        Timer(interval, self._repeater, [interval, function]).start()
-        function()
+    # Таблица статистики за месяц для роли
+    def _build_stat(self, year: int, month: int, role: str, version: float) -> pandas.DataFrame:
+        data = self._format_stat(self._get_stat_totals(year, month))
+        data.insert(1, 'gid', data['senderid'])
+        data['gid'] = data['gid'].map(self._dircache.groups)
+        data['sender'] = data['sender'].map(self._dircache.users)
+        data = data.rename(columns={'senderid': 'ID радиостанции', 'gid': 'Группа', 'sender': 'Должность', 'sum': 'Общее время', 'len': 'Количество сеансов', 'avg': 'Среднее время'})
+        return self._filter_recs(data, role)
+
+    # Итоги за месяц из общего для процессов хранилища, итоги незакрытого месяца хранятся не дольше ttl
+    def _get_stat_totals(self, year: int, month: int) -> pandas.DataFrame:
+        sopts = self._options.get('stat', {})
+        if not sopts.get('shared', True):
+            return self._load_stat_totals(year, month)
+        name = f'stat:{year}-{month:02d}'
+        data = self._shared.get(name)
+        if data is None:
+            data = self._load_stat_totals(year, month)
+            self._shared.set(name, data, sopts.get('ttl', 300) if self._month_live(year, month) else None)
+        return data
+
+    # Итоги за месяц: закрытые недели из локального хранилища, остальные из MySQL
+    def _load_stat_totals(self, year: int, month: int) -> pandas.DataFrame:
+        if self._options.get('stat', {}).get('aggregate', 'sql') == 'pandas':
+            return self._calls_stat(self._month_calls(year, month))
+        if self._rollup is None:
+            return self._db_mysql_get_stat(year, month)
 
-    # Возвращает номер недели в году
-    def _get_week(self, year: int, month: int, day: int) -> int:
-        return int(datetime.date(year, month, day).isocalendar()[1])
+        tnames = self._month_tables(year, month)
+        closed = self._rollup.closed_tables()
+        rolled = [tname for tname in tnames if tname in closed]
+        live = [tname for tname in tnames if tname not in closed]
 
-    # Переводит миллисекунды в часы, минуты, секунды
-    def _msec2hms(self, msec: int) -> str:
-        seconds = int((msec / 1000) % 60)
-        minutes = int((msec / (1000 * 60)) % 60)
-        hours = int((msec / (1000 * 60 * 60)) % 24)
-        return f'{hours:02d}:{minutes:02d}:{seconds:02d}'
+        days = monthrange(year, month)[1]
+        frames = [self._rollup.get_stat(rolled, datetime.date(year, month, 1), datetime.date(year, month, days))]
+        if len(live) > 0:
+            frames.append(self._db_mysql_get_stat(year, month, live)[['senderid', 'sum', 'len']])
+
+        data = pandas.concat(frames).astype('int64').groupby('senderid', as_index=False).sum()
+        data['avg'] = data['sum'] // data['len']
+        return data.sort_values(['len'], ascending=False).reset_index(drop=True)
+
+    # Звонки за месяц из общего кэша, упорядоченные по senderid и времени начала
+    def _month_calls(self, year: int, month: int) -> pandas.DataFrame:
+        return self._calls.get((year, month), self._month_live(year, month))
+
+    # Признак месяца, данные которого еще могут пополняться
+    def _month_live(self, year: int, month: int) -> bool:
+        today = datetime.date.today()
+        return (year, month) >= (today.year, today.month) or any(not TableCatalog.closed(tname) for tname in self._month_tables(year, month))
+
+    # Итоги по радиостанциям из звонков за месяц, строки радиостанции выбираются двоичным поиском
+    def _calls_stat(self, calls: pandas.DataFrame) -> pandas.DataFrame:
+        lo, hi = calls['senderid'].searchsorted(1000, side='left'), calls['senderid'].searchsorted(9999, side='right')
+        data = calls.iloc[lo:hi].groupby('senderid', as_index=False, sort=False)['duration'].agg(['sum', 'count']).rename(columns={'count': 'len'})
+        data = data.astype('int64')
+        data['avg'] = data['sum'] // data['len']
+        return data.sort_values(['len'], ascending=False).reset_index(drop=True)
+
+    # Нагрузка за месяц в ячейках день недели x час (168 ячеек) и эфир радиостанций по часам суток (с)
+    # Звонок относится к часу своего начала, разбиение выполняется векторно без циклов по звонкам
+    # Учитываются только звонки радиостанций из групп, видимых роли
+    def _get_load(self, year: int, month: int, role: str, version: float) -> dict:
+        calls = self._month_calls(year, month)
+        visible = self._filter_recs(pandas.DataFrame({'Группа': calls['senderid'].map(self._dircache.groups)}), role).index
+        if len(visible) < len(calls):
+            calls = calls.take(visible)
+        start = calls['starttime'].to_numpy().astype('datetime64[s]').astype('int64')
+        end = numpy.maximum(calls['endtime'].to_numpy().astype('datetime64[s]').astype('int64'), start)
+        secs = calls['duration'].to_numpy() / 1000
+        hours = start // 3600
+        # 01.01.1970 - четверг, поэтому понедельнику соответствует 0
+        cells = (hours // 24 + 3) % 7 * 24 + hours % 24
+        codes, senders = pandas.factorize(calls['senderid'])
+        byhour = numpy.bincount(codes * 24 + hours % 24, weights=secs, minlength=len(senders) * 24).reshape(-1, 24)
+        return {'count': numpy.bincount(cells, minlength=168), 'airtime': numpy.bincount(cells, weights=secs, minlength=168),
+                'peak': self._peak_load(start, end), 'senders': pandas.DataFrame(byhour, index=senders, columns=range(24))}
+
+    # Пик одновременных звонков по ячейкам день недели x час методом заметающей прямой
+    def _peak_load(self, start: numpy.ndarray, end: numpy.ndarray) -> numpy.ndarray:
+        peak = numpy.zeros(168, dtype='int64')
+        if len(start) == 0:
+            return peak
+
+        # События начала (+1) и окончания (-1), при равном времени окончание учитывается раньше
+        times = numpy.concatenate([start, end])
+        steps = numpy.concatenate([numpy.ones(len(start), dtype='int64'), numpy.full(len(end), -1, dtype='int64')])
+        order = numpy.lexsort((steps, times))
+        times, level = times[order], numpy.cumsum(steps[order])
+
+        # Уровень на начало каждого часа и максимум после событий внутри часа
+        hours = numpy.arange(times[0] // 3600, times[-1] // 3600 + 1)
+        idx = numpy.searchsorted(times, hours * 3600, side='right')
+        hourpeak = numpy.where(idx > 0, level[numpy.maximum(idx - 1, 0)], 0)
+        numpy.maximum.at(hourpeak, times // 3600 - hours[0], level)
+        numpy.maximum.at(peak, (hours // 24 + 3) % 7 * 24 + hours % 24, hourpeak)
+        return peak
+
+    # Переводит итоги в отображаемый вид
+    def _format_stat(self, data: pandas.DataFrame) -> pandas.DataFrame:
+        data = data.copy()
+        data['avg'] = self._msec2hms(data['avg'])
+        data['sum'] = self._msec2hms(data['sum'])
+        data.insert(1, 'sender', data['senderid'])
+        return data
 
-    # Возвращает среднее значение по времени свззи
-    def _avg(self, s :int, l: int) -> str:
-        return self._msec2hms(int(s/l)) if l > 0 else self._msec2hms(0)
+    # Обновляет локальное хранилище итогов
+    def _rollup_sync(self) -> None:
+        try:
+            with self._health.connect('mysql') as conn:
+                self._rollup.sync(conn, self._catalog.names())
+        except (exc.DBAPIError, BackendDown) as err:
+            pass
+
+    # Заполняет каталог, справочники и статистику за последние два месяца для всех ролей
+    def _warm(self) -> None:
+        # Ошибка шага не прерывает прогрев, а только отмечается в ответе готовности
+        def step(name: str, func) -> None:
+            try:
+                func()
+            except Exception as err:
+                self._warmup['errors'].append(f'{name}: {err!r}')
+
+        self._warmup['started'] = time.time()
+        try:
+            if self._primary:
+                step('catalog', self._catalog_sync)
+            step('dirs', lambda: self._dircache.version)
+            step('mindate', self._minday)
+            roles = sorted({user.get('role', 'user') for user in self._users.values()})
+            periods = []
+            step('periods', lambda: periods.extend(sorted(self._catalog.periods())[-2:]))
+            for year, month in periods:
+                for role in roles:
+                    step(f'stat {year}-{month:02d} {role}', lambda: self.getstat(year, month, role))
+        finally:
+            self._warmup['finished'] = time.time()
+            self._warmup['ready'] = True
+
+    # Сбрасывает данные незакрытых месяцев, если в последнюю недельную таблицу добавились звонки
+    # Основной процесс проверяет время последнего звонка по индексу starttime и публикует его в общем хранилище,
+    # остальные процессы только сверяются с опубликованным значением
+    def _stat_watch(self) -> None:
+        if self._primary:
+            tnames = self._catalog.names()
+            if len(tnames) == 0:
+                return
+            try:
+                with self._health.connect('mysql') as conn:
+                    stamp = (tnames[-1], conn.execute(text(f'select max(starttime) from {tnames[-1]};')).scalar())
+            except (exc.DBAPIError, BackendDown) as err:
+                return
+            if stamp != self._shared.get('livestamp'):
+                # Последняя неделя может начинаться в предыдущем месяце
+                for day in (datetime.date.today(), datetime.date.today() - datetime.timedelta(days=6)):
+                    self._shared.delete(f'stat:{day.year}-{day.month:02d}')
+                self._shared.set('livestamp', stamp)
+
+        stamp = self._shared.get('livestamp')
+        if self._livestamp is not None and stamp != self._livestamp:
+            # Звонки и нагрузка за месяц загружаются целиком, поэтому для них достаточно срока ttl
+            self._stats.invalidate(True)
+        self._livestamp = stamp
+
+    # Заполняет кэш аудиозаписями за последние сутки
+    def _audio_prewarm(self) -> None:
+        try:
+            fpaths = self._db_pgsql_get_recent_paths()
+        except (exc.DBAPIError, BackendDown) as err:
+            return
+        for fpath in fpaths:
+            try:
+                self._audiocache.get(os.path.join(self._recdir, fpath))
+            except (OSError, RuntimeError) as err:
+                pass
+
+    # Дополняет индекс аудиозаписей новыми и измененными файлами
+    def _audio_index(self) -> None:
+        try:
+            self._audioindex.scan()
+        except (OSError, sqlite3.Error) as err:
+            pass
+
+    # Обновляет каталог недельных таблиц
+    def _catalog_sync(self) -> None:
+        try:
+            with self._health.connect('mysql') as conn:
+                self._catalog.refresh(conn)
+        except (exc.DBAPIError, BackendDown) as err:
+            pass
+
+    # Возвращает список недельных таблиц за месяц
+    def _month_tables(self, year: int, month: int) -> list:
+        return self._catalog.tables(year, month)
+
+    # Переводит столбец миллисекунд в часы, минуты, секунды (часы не ограничены сутками)
+    def _msec2hms(self, msec: pandas.Series) -> pandas.Series:
+        secs = msec.astype('int64') // 1000
+        hours = (secs // 3600).astype(str).str.zfill(2)
+        minutes = (secs // 60 % 60).astype(str).str.zfill(2)
+        seconds = (secs % 60).astype(str).str.zfill(2)
+        return hours + ':' + minutes + ':' + seconds
+
+    # Переводит столбец 'ЧЧ:ММ:СС' обратно в секунды (часы могут быть трехзначными)
+    def _hms2sec(self, hms: pandas.Series) -> pandas.Series:
+        parts = hms.astype(str).str.extract(r'^(\d+):(\d+):(\d+)$').astype('float64')
+        return parts[0] * 3600 + parts[1] * 60 + parts[2]
 
     # Возвращает номер месяца по его имени
     def _month2num(self, name: str) -> int:
@@ -236,28 +1599,22 @@ class DMRApp():
               7: 'Июль', 8: 'Август', 9: 'Сентябрь', 10: 'Октябрь', 11: 'Ноябрь', 12: 'Декабрь'}
         return mn[num]
 
-    # Конвертирует время в UTC во время в GMT
+    # Конвертирует время в UTC в местное время
     def _u2g(self, dt: datetime.datetime) -> datetime.datetime:
-        dt = str(dt).split('.', 1)[0]
+        dt = dt.replace(microsecond=0)
+        dt = dt.replace(tzinfo=datetime.timezone.utc) if dt.tzinfo is None else dt
+        return dt.astimezone(self._tz)
 
-        from_tz = tz.gettz('UTC')
-        to_tz = tz.gettz('GMT+7')
+    # Конвертирует столбец времени в UTC в местное время (строковое представление)
+    def _utc2gmt(self, dt: pandas.Series) -> pandas.Series:
+        dt = pandas.to_datetime(dt)
+        dt = dt.dt.tz_localize('UTC') if dt.dt.tz is None else dt
+        return dt.dt.tz_convert(self._tz).dt.strftime('%d.%m.%Y %H:%M:%S')
 
-        utc = datetime.datetime.strptime(dt, '%Y-%m-%d %H:%M:%S')
-        utc = utc.replace(tzinfo=from_tz)
-        gmt = utc.astimezone(to_tz)
-        return gmt
-
-    # Конвертирует время в UTC во время в GMT (строковое представление)
-    def _utc2gmt(self, dt: str) -> str:
-        gmt = self._u2g(dt)
-        return gmt.strftime('%d.%m.%Y %H:%M:%S')
-
-    # Конвертирует время в GMT во время в UTC
+    # Конвертирует местное время в UTC
     def _gmt2utc(self, dt: str) -> str:
-        tmp = parser.parse(dt)
-        dtmp = tmp.replace(tzinfo=pytz.utc) + tmp.tzinfo._offset
-        return dtmp.strftime('%Y-%m-%d %H:%M:%S')
+        tmp = datetime.datetime.strptime(dt, '%Y-%m-%d %H:%M:%S').replace(tzinfo=self._tz)
+        return tmp.astimezone(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
 
     # Возвращает текущую дату для календаря
     def _today(self) -> str:
@@ -265,7 +1622,13 @@ class DMRApp():
 
     # День, ранее которого нельзя выбрать дату в календаре
     def _minday(self) -> str:
-        dt = self._db_pgsql_get_mindate()
+        dt = self._shared.get('mindate')
+        if dt is None:
+            dt = self._db_pgsql_get_mindate()
+            # Записей еще нет, ограничение снизу не требуется
+            if dt is None:
+                return self._maxday()
+            self._shared.set('mindate', dt, self._options.get('dircache', {}).get('ttl', 300))
         gmt = self._u2g(dt)
         return gmt.strftime('%Y/%m/%d')
 
@@ -275,349 +1638,511 @@ class DMRApp():
         gmt = datetime.datetime.now()
         return gmt.strftime('%Y/%m/%d')
 
+    # Поле ввода даты с календарем
+    def _date_input(self, label: str, value: str) -> tuple:
+        with ui.input(label, value=value) as inp:
+            with inp.add_slot('append'):
+                icon = ui.icon('edit_calendar').classes('cursor-pointer')
+            with ui.menu().props(remove='auto-close') as menu:
+                picker = ui.date(mask='DD.MM.YYYY', on_change=menu.close).props(add='no-unset').bind_value(inp)
+            icon.on('click', menu.open)
+        return inp, picker
+
+    # Сообщение о недоступных БД в заголовке страницы
+    def _show_health(self, st: ClientState) -> None:
+        down = [state['title'] for state in self._health.status.values() if not state['up']]
+        st.lb_health.set_text(f'Недоступна БД: {", ".join(down)}' if len(down) > 0 else '')
+
+    # Подготавливает выдачу аудиозаписи, cached - с перекодированием через кэш
+    def _audio_stream(self, fpath: str, cached: bool) -> AudioStream:
+        with self._metrics.timer('audio_open'):
+            return AudioStream(self._audiocache.get(fpath) if cached else fpath)
+
     # Устанавливает источник воспроизведения
-    def _set_au_source(self, src: str) -> None:
-        self._au_player._handle_source_change(src)
-        app.storage.user['media'] = src
+    def _set_au_source(self, st: ClientState, src: str) -> None:
+        st.au_player._handle_source_change(src)
+        st.media = src
     #endregion
 
     #region Работа с БД
-    #
-    def _db_mysql_keepalive(self):
-        try:
-            self._mysql.execute(text('select 1;'))
-        except exc.DBAPIError as err:
-            pass
-    #
-    def _db_check_connection(self, connection):
-        try:
-            connection.execute(text('select 1;'))
-        except exc.DBAPIError as err:
-            connection.connect()
+    # Возвращает признак изменения справочников радиостанций и групп
+    def _db_pgsql_get_dirstamp(self) -> tuple:
+        with self._health.connect('pgsql') as conn:
+            data = conn.execute(text('select (select count(*) from abonents), (select max(ab_id) from abonents), (select count(*) from abonent_group), (select count(*) from groups);'))
+            return tuple(data.fetchone())
 
     # Получает список радиостанций с их ID
     def _db_pgsql_get_users(self) -> dict:
-        self._db_check_connection(self._pgsql)
-        users = self._pgsql.execute(text('select name, abonentid from abonents;'))
-        users = pandas.DataFrame(users).to_dict(orient='records')
+        with self._health.connect('pgsql') as conn:
+            users = conn.execute(text('select name, abonentid from abonents;'))
+            users = pandas.DataFrame(users).to_dict(orient='records')
         users_dict = {int(e['abonentid']):e['name'] for e in users if e['abonentid'].isdigit() }
         return users_dict
 
     # Получает список радиостанций с их группами
     def _db_pgsql_get_groups(self) -> dict:
-        self._db_check_connection(self._pgsql)
-        groups = self._pgsql.execute(text('select abonents.abonentid, groups.groupname from abonent_group, abonents, groups where abonent_group.ab_id = abonents.ab_id and abonent_group.group_id = groups.groupid;'))
-        groups = pandas.DataFrame(groups).to_dict(orient='records')
+        with self._health.connect('pgsql') as conn:
+            groups = conn.execute(text('select abonents.abonentid, groups.groupname from abonent_group, abonents, groups where abonent_group.ab_id = abonents.ab_id and abonent_group.group_id = groups.groupid;'))
+            groups = pandas.DataFrame(groups).to_dict(orient='records')
         groups_dict = {int(e['abonentid']):e['groupname'] for e in groups if e['abonentid'].isdigit() }
         return groups_dict
 
     # Возвращает список записей на определенную дату
-    def _db_pgsql_get_records(self, dt: str) -> pandas.DataFrame:
-        self._db_check_connection(self._pgsql)
-        dtstart = self._gmt2utc(f'{dt} 00:00:00 GMT+7')
-        dtend =  self._gmt2utc(f'{dt} 23:59:59 GMT+7')
-        rec = self._pgsql.execute(text(f'select id, caller, abonents.name, datetimestart, datetimeend from sessions, abonents where (datetimestart between \'{dtstart}\' and \'{dtend}\') and abonents.abonentid = caller;'))
-        rec = pandas.DataFrame(rec)
-        if len(rec) > 0:
-            rec['datetimestart'] = rec.apply(lambda row: self._utc2gmt(row['datetimestart']), axis=1)
-            rec['datetimeend'] = rec.apply(lambda row: self._utc2gmt(row['datetimeend']), axis=1)
-        return rec
+    # Сеансы за период UTC в порядке (datetimestart, id), after - ключ последней строки предыдущей страницы
+    def _db_pgsql_get_records(self, dtstart: str, dtend: str, caller: Optional[int] = None, name: str = '', after: Optional[tuple] = None, limit: Optional[int] = None) -> tuple:
+        sql = 'select s.id, s.caller, a.name, s.datetimestart, s.datetimeend, s.filepath from sessions s join abonents a on a.abonentid = s.caller where s.datetimestart between :dtstart and :dtend'
+        params = {'dtstart': dtstart, 'dtend': dtend}
+        if caller is not None:
+            sql += ' and s.caller = :caller'
+            params['caller'] = str(caller)
+        if name != '':
+            sql += ' and a.name ilike :name'
+            params['name'] = f'%{name}%'
+        if after is not None:
+            sql += ' and (s.datetimestart, s.id) > (:afterstart, :afterid)'
+            params['afterstart'], params['afterid'] = after
+        sql += ' order by s.datetimestart, s.id'
+        if limit is not None:
+            sql += ' limit :limit'
+            params['limit'] = limit
+        with self._health.connect('pgsql') as conn:
+            rows = conn.execute(text(sql), params).fetchall()
+        last = (rows[-1].datetimestart, rows[-1].id) if len(rows) > 0 else None
+        return pandas.DataFrame(rows, columns=['id', 'caller', 'name', 'datetimestart', 'datetimeend', 'filepath']), last
 
     # Возвращает минимальное значение даты, на которую есть записи
     def _db_pgsql_get_mindate(self) -> str:
-        self._db_check_connection(self._pgsql)
-        data = self._pgsql.execute(text('select min(datetimestart) from sessions;'))
-        data = data.fetchone()
+        with self._health.connect('pgsql') as conn:
+            data = conn.execute(text('select min(datetimestart) from sessions;'))
+            data = data.fetchone()
         return data[0]
 
     # Возвращает путь к аудиозаписи в локальной файловой системе
     def _db_pgsql_get_record_path(self, id: str) -> str:
-        self._db_check_connection(self._pgsql)
-        data = self._pgsql.execute(text(f'select filepath from sessions where id = \'{str(id)}\';'))
-        data = data.fetchone()
+        with self._health.connect('pgsql') as conn:
+            data = conn.execute(text('select filepath from sessions where id = :id;'), {'id': str(id)})
+            data = data.fetchone()
         return data[0]
 
+    # Возвращает пути к аудиозаписям за последние сутки, на которые есть записи
+    def _db_pgsql_get_recent_paths(self) -> list:
+        with self._health.connect('pgsql') as conn:
+            data = conn.execute(text('select filepath from sessions where datetimestart >= (select max(datetimestart) from sessions) - interval \'1 day\' order by datetimestart desc;'))
+            return [row[0] for row in data.fetchall()]
+
     # Возвращает список имен радиогрупп
     def _db_pgsql_get_group_names(self) -> list:
-        self._db_check_connection(self._pgsql)
-        data = self._pgsql.execute(text(f'select groupname from groups;'))
-        data = list(*zip(*data.fetchall()))
+        with self._health.connect('pgsql') as conn:
+            data = conn.execute(text(f'select groupname from groups;'))
+            data = list(*zip(*data.fetchall()))
         data.sort()
         data.append('Все группы')
         return data
 
     # Функция возвращает список лет, информация за которые имеется в БД
     def _db_mysql_get_years(self) -> list:
-        self._db_check_connection(self._mysql)
-        tnames = self._mysql.execute(text('show tables like \'rptbiz%\';'))
-        tnames = list(zip(*tnames.fetchall()))
-        if len(tnames) > 0:
-            years = [int(tname[6:10]) for tname in tnames[0]]
-            return pandas.Series(years).drop_duplicates().to_list()
-        else:
-            return []
+        return self._catalog.years()
 
     # Функция возвращает список месяцев за указанный год, в которых есть сеансы связи
     def _db_mysql_get_months(self, year: int, intres: bool = True) -> list:
-        self._db_check_connection(self._mysql)
-        res = []
-        tnames = self._mysql.execute(text(f'show tables like \'rptbiz{str(year)}%\';'))
-        tnames = list(zip(*tnames.fetchall()))
-        if len(tnames) > 0:
-            for tname in tnames[0]:
-                months = self._mysql.execute(text(f'select month(starttime) from {tname}  group by month(starttime);'))
-                months = list(zip(*months.fetchall()))
-                if len(months) > 0:
-                    for month in months[0]:
-                        res.append(month)
-        res = pandas.Series(res).drop_duplicates().to_list()
+        res = self._catalog.months(year)
         return res if intres else [self._num2month(itm) for itm in res]
 
-    # Функция возвращает статистическую информацию по радиосвязи за определенный месяц года
-    def _db_mysql_get_stat(self, year: int, month: int) -> pandas.DataFrame:
-        self._db_check_connection(self._mysql)
+    # Формирует запрос UNION ALL по недельным таблицам за определенный месяц года
+    def _db_mysql_month_query(self, year: int, month: int, fields: str, cond: str, tnames: Optional[list] = None) -> str:
         days = monthrange(year, month)[1]
-        fweek = self._get_week(year, month, 1)
-        lweek = self._get_week(year, month, days)
         fdm = datetime.datetime(year, month, 1, 0, 0, 0)
         ldm = datetime.datetime(year, month, days, 23, 59, 59)
 
-        tmpl = f'rptbiz{str(year)}'
-        seltmpl = ''
-
-        for m in range(fweek, lweek + 1):
-            seltmpl += f'select senderid, starttime, duration from {tmpl}{m:02d} where (`starttime` between \'{fdm.strftime("%Y-%m-%d %H:%M:%S")}\' and \'{ldm.strftime("%Y-%m-%d %H:%M:%S")}\') and (`senderid` between 1000 and 9999) and `calltype`=1 union '
-        seltmpl = f'{seltmpl[0:-7]};'
+        sels = []
 
-        data = pandas.DataFrame(self._mysql.execute(text(seltmpl)))
-        data = pandas.DataFrame.pivot_table(data[['senderid', 'duration']], index=['senderid'], aggfunc=['sum',len])
-        data = data.reset_index().droplevel(1, axis=1).sort_values(['len'], ascending=False)
+        for tname in tnames if tnames is not None else self._month_tables(year, month):
+            sels.append(f'select {fields} from {tname} where (`starttime` between \'{fdm.strftime("%Y-%m-%d %H:%M:%S")}\' and \'{ldm.strftime("%Y-%m-%d %H:%M:%S")}\') and {cond} and `calltype`=1')
+        return ' union all '.join(sels)
 
-        data['avg'] = data.apply(lambda row: self._avg(row['sum'],row['len']), axis=1)
-        data['sum'] = data.apply(lambda row: self._msec2hms(row['sum']), axis=1)
+    # Функция возвращает итоги по радиосвязи за определенный месяц года (время в мс)
+    def _db_mysql_get_stat(self, year: int, month: int, tnames: Optional[list] = None) -> pandas.DataFrame:
+        seltmpl = self._db_mysql_month_query(year, month, 'senderid, starttime, duration', '(`senderid` between 1000 and 9999)', tnames)
+        if seltmpl == '':
+            return pandas.DataFrame({name: pandas.Series(dtype='int64') for name in ('senderid', 'sum', 'len', 'avg')})
 
-        data.insert(1, 'sender', data['senderid'])
+        # Агрегация на стороне MySQL, по строке на радиостанцию
+        seltmpl = f'select senderid, sum(duration) as `sum`, count(*) as `len`, avg(duration) as `avg` from ({seltmpl}) as calls group by senderid order by `len` desc;'
+        with self._health.connect('mysql') as conn:
+            data = pandas.DataFrame(conn.execute(text(seltmpl)), columns=['senderid', 'sum', 'len', 'avg'])
 
         return data.reset_index(drop=True)
 
-    # Функция возвращает статистическую информацию по радиосвязи за определенный месяц года
-    def _db_mysql_get_detail(self, rid: int, year: int, month: int) -> pandas.DataFrame:
-        self._db_check_connection(self._mysql)
-        days = monthrange(year, month)[1]
-        fweek = self._get_week(year, month, 1)
-        lweek = self._get_week(year, month, days)
-        fdm = datetime.datetime(year, month, 1, 0, 0, 0)
-        ldm = datetime.datetime(year, month, days, 23, 59, 59)
-
-        tmpl = f'rptbiz{str(year)}'
-        seltmpl = ''
-
-        for m in range(fweek, lweek + 1):
-            seltmpl += f'select senderid, starttime, duration, endtime from {tmpl}{m:02d} where (`starttime` between \'{fdm.strftime("%Y-%m-%d %H:%M:%S")}\' and \'{ldm.strftime("%Y-%m-%d %H:%M:%S")}\') and (`senderid` = {rid}) and `calltype`=1 union '
-        seltmpl = f'{seltmpl[0:-7]};'
+    # Функция возвращает звонки за месяц (всех или одной радиостанции) в компактных типах, упорядоченные по senderid и времени начала
+    def _db_mysql_get_calls(self, year: int, month: int, rid: Optional[int] = None) -> pandas.DataFrame:
+        seltmpl = self._db_mysql_month_query(year, month, 'senderid, starttime, duration, endtime', f'(`senderid` = {int(rid)})' if rid is not None else 'true')
 
-        data = pandas.DataFrame(self._mysql.execute(text(seltmpl)))
-        data.insert(1, 'sender', data['senderid'])
-        return data.reset_index(drop=True)
+        rows = []
+        if seltmpl != '':
+            with self._health.connect('mysql') as conn:
+                rows = conn.execute(text(f'{seltmpl};')).fetchall()
+        data = pandas.DataFrame(rows, columns=['senderid', 'starttime', 'duration', 'endtime'])
+        data = data.astype({'senderid': 'int32', 'duration': 'int32', 'starttime': 'datetime64[s]', 'endtime': 'datetime64[s]'})
+        return data.sort_values(['senderid', 'starttime'], kind='stable').reset_index(drop=True)
 
     #endregion
 
     #region Обработчики событий
     # Изменение месяца
-    def _change_month(self) -> None:
-        self._sdata = self.getstat(int(self._sl_year.value), self._month2num(self._sl_month.value))
-        self._cont_t1.remove(self._tb_data)
-        with self._cont_t1:
-            self._tb_data = ui.table.from_pandas(self._sdata).classes('w-full')
-            self._tb_data.add_slot('body-cell', r"""
-                <q-td :props="props" @dblclick="$parent.$emit('cell_dblclick', props)">
-                    {{ props.value }}
-                </q-td>
-                """)
-            self._tb_data.on('cell_dblclick', lambda msg: self.detail(msg.args.get('row')))
-        res = None
+    async def _change_month(self, st: ClientState) -> None:
+        st.tb_data.props('loading')
+        st.sl_month.disable()
+        try:
+            st.sdata = await self.agetstat(int(st.sl_year.value), self._month2num(st.sl_month.value), st.role)
+            st.sindex = self._group_index(st.sdata)
+        finally:
+            st.sl_month.enable()
+            st.tb_data.props(remove='loading')
+        st.pt_data.set_data(st.sdata, self._group_rows(st))
+        st.bt_download.enable()
 
     # Изменение года
-    def _change_year(self) -> None:
-        months = self._db_mysql_get_months(self._sl_year.value, False)
-        self._sl_month.options = months
-        self._sl_month.value = months[-1]
-
-    # Изменение группы
-    def _change_group(self) -> None:
-        res = self._sdata
+    async def _change_year(self, st: ClientState) -> None:
+        months = await self._run(self._db_mysql_get_months, st.sl_year.value, False)
+        st.sl_month.options = months
+        st.sl_month.value = months[-1]
+
+    # Начальная загрузка годов, выбор последнего года подгружает его месяцы и статистику
+    async def _load_years(self, st: ClientState) -> None:
+        years = await self._run(self._db_mysql_get_years)
+        st.sl_year.options = years
+        st.sl_year.value = years[-1]
+
+    # Начальная загрузка списка групп
+    async def _load_groups(self, st: ClientState) -> None:
+        st.sl_group.options = self._filter_groups(await self._run(lambda: self._dircache.names), st.role)
+        st.sl_group.update()
+
+    # Первое открытие вкладок звукозаписи и нагрузки
+    async def _open_tab(self, st: ClientState, value) -> None:
+        if not st.lloaded and value in ('Нагрузка', st.tab3):
+            st.lloaded = True
+            years = await self._run(self._db_mysql_get_years)
+            st.sl_lyear.options = years
+            st.sl_lyear.value = years[-1]
+            return
+        if st.role == "user" or st.zloaded or value not in ('Звукозапись', st.tab2):
+            return
+        st.zloaded = True
+        minday, _ = await asyncio.gather(self._run(self._minday), self._search_records(st))
+        for picker in (st.dt_from, st.dt_to):
+            picker.props(f''':options="date => date >= '{minday}' && date <= '{self._maxday()}'"''')
+
+    # Изменение года на вкладке нагрузки
+    async def _change_load_year(self, st: ClientState) -> None:
+        months = await self._run(self._db_mysql_get_months, st.sl_lyear.value, False)
+        st.sl_lmonth.options = ['Весь год'] + months
+        if st.sl_lmonth.value == months[-1]:
+            await self._change_load(st)
+        else:
+            st.sl_lmonth.value = months[-1]
 
-        if self._sl_group.value != 'Все группы':
-            res = res[res['Группа'] == self._sl_group.value]
+    # Изменение периода на вкладке нагрузки
+    async def _change_load(self, st: ClientState) -> None:
+        if st.sl_lmonth.value is None:
+            return
+        month = None if st.sl_lmonth.value == 'Весь год' else self._month2num(st.sl_lmonth.value)
+        st.tb_load.props('loading')
+        st.sl_lmonth.disable()
+        try:
+            st.lload = await self.agetload(int(st.sl_lyear.value), month, st.role)
+        finally:
+            st.sl_lmonth.enable()
+            st.tb_load.props(remove='loading')
+        st.pt_load.set_data(st.lload['groups'])
+        self._show_load(st)
+
+    # Отображает выбранный показатель нагрузки на тепловой карте
+    def _show_load(self, st: ClientState) -> None:
+        if st.lload is None:
+            return
+        cells = st.lload[st.sl_metric.value]
+        st.ch_load.options['series'][0]['data'] = [[hour, day, value] for day, row in enumerate(cells.to_numpy().tolist()) for hour, value in enumerate(row)]
+        st.ch_load.options['visualMap']['max'] = max(float(cells.to_numpy().max()), 1)
+        st.ch_load.update()
 
-        self._cont_t1.remove(self._tb_data)
-        with self._cont_t1:
-            self._tb_data = ui.table.from_pandas(res).classes('w-full')
-            self._tb_data.add_slot('body-cell', r"""
-                <q-td :props="props" @dblclick="$parent.$emit('cell_dblclick', props)">
-                    {{ props.value }}
-                </q-td>
-                """)
-            self._tb_data.on('cell_dblclick', lambda msg: self.detail(msg.args.get('row')))
-        res = None
+    # Изменение группы
+    def _change_group(self, st: ClientState) -> None:
+        st.pt_data.set_rows(self._group_rows(st))
 
     # Загрузка статистики
-    def _download_data(self) -> None:
-        alph = list(map(chr, range(ord('A'), ord('Z')+1)))
-        name = f'{str(self._sl_year.value)}-{self._sl_month.value}'
-        fl = io.BytesIO()
-        ew = pandas.ExcelWriter(fl)
-
-        res = self._sdata
-
-        if self._sl_group.value != 'Все группы':
-            res = res[res['Группа'] == self._sl_group.value]
-
-        res.to_excel(ew, sheet_name=name, index=False)
-
-        for column in res:
-            column_width = max(res[column].astype(str).map(len).max(), len(column)) + 3
-            col_idx = res.columns.get_loc(column)
-            ew.sheets[name].column_dimensions[alph[col_idx]].width = column_width
-        ew.close()
-        fl.seek(0, 0)
-        ui.download(fl.read(), f'{name}.xlsx')
-
-    # Изменение даты
-    def _change_date(self) -> None:
-        self._mn_date.close()
-        self._zdata = self.getzz(self._in_date.value)
-        self._cont_t2.remove(self._tb_zdata)
-        with self._cont_t2:
-            self._tb_zdata = ui.table.from_pandas(self._zdata, selection='single', on_select=self._row_select).classes('w-full')
-        if len(self._zdata) > 0:
-            for i in range(0, 5):
-                self._tb_zdata.columns[i]['label'] = ['ID Такт ПРО', 'ID радиостанции', 'Должность', 'Начало сеанса', 'Конец сеанса'][i]
+    async def _download_data(self, st: ClientState) -> None:
+        if st.sl_month.value is None:
+            return
+        periods = {f'{year}-{month:02d}': f'{self._num2month(month)} {year}' for year, month in await self._run(self._catalog.periods)}
+        current = f'{st.sl_year.value}-{self._month2num(st.sl_month.value):02d}'
+        owner = app.storage.browser['id']
+
+        def start() -> None:
+            first, last = sorted([sl_from.value, sl_to.value])
+            sel = [tuple(map(int, key.split('-'))) for key in periods if first <= key <= last]
+            group = st.sl_group.value
+            fname = f'{first}_{last}.{sl_format.value}' if first != last else f'{first}.{sl_format.value}'
+            job = self._exports.submit(owner, fname, lambda fpath, progress: self._export_stat(fpath, progress, sel, group, cb_groups.value, st.role))
+            bt_start.disable()
+
+            def poll() -> None:
+                info = self._exports.status(job, owner)
+                pb_export.set_value(info['progress'])
+                if not info['done']:
+                    return
+                timer.active = False
+                bt_start.enable()
+                if info['error'] is not None:
+                    ui.notify(f'Ошибка выгрузки: {info["error"]}', color='negative')
+                else:
+                    ui.link('Скачать файл', f'/download/export/{job}').props('download')
+                    ui.download(f'/download/export/{job}')
+
+            with card:
+                timer = ui.timer(0.5, poll)
+
+        with st.cont_t1, ui.dialog() as dlg, ui.card().classes('w-96') as card:
+            sl_from = ui.select(periods, label='С', value=current).classes('w-full')
+            sl_to = ui.select(periods, label='По', value=current).classes('w-full')
+            sl_format = ui.select(['xlsx', 'csv'], label='Формат', value='xlsx').classes('w-full')
+            cb_groups = ui.checkbox('Группы на отдельных листах')
+            pb_export = ui.linear_progress(value=0, show_value=False)
+            with ui.row().classes('w-full justify-end'):
+                bt_start = ui.button('Сформировать', on_click=start)
+                ui.button('Закрыть', on_click=dlg.close)
+        # Диалог создается при каждом нажатии, поэтому после закрытия удаляется вместе с таймером
+        dlg.on('hide', dlg.delete)
+        dlg.open()
+
+    # Поиск звукозаписей по периоду и фильтрам, more - дозагрузка следующей страницы
+    async def _search_records(self, st: ClientState, more: bool = False) -> None:
+        st.tb_zdata.props('loading')
+        st.bt_zsearch.disable()
+        try:
+            caller = int(st.in_caller.value) if (st.in_caller.value or '').strip() != '' else None
+            page, st.zcursor = await self.asearchzz(f'{st.in_from.value} {st.in_tfrom.value}', f'{st.in_to.value} {st.in_tto.value}',
+                                                    caller, st.in_name.value, st.zcursor if more else None, self._records_page)
+        except ValueError:
+            ui.notify('Неверно заданы условия поиска', color='negative')
+            return
+        finally:
+            st.bt_zsearch.enable()
+            st.tb_zdata.props(remove='loading')
+        st.zdata = pandas.concat([st.zdata, page], ignore_index=True) if more else page
+        st.bt_zmore.set_enabled(st.zcursor is not None)
+        st.pt_zdata.set_data(st.zdata)
 
     # Выбор записи в таблице звукозаписи
-    def _row_select(self, e) -> None:
+    async def _row_select(self, st: ClientState, e) -> None:
         if e.selection != []:
-            fpath = self._db_pgsql_get_record_path(e.selection[0]['id'])
-            self._sndfile.set_source(os.path.join(self._recdir, fpath))
-            self._set_au_source(self._sndfile.uri)
+            fpath = await self._run(self._db_pgsql_get_record_path, e.selection[0]['id'])
+            fpath = os.path.join(self._recdir, fpath)
+            st.sndfile.set_source(await self._run(self._audiocache.get, fpath))
+            self._set_au_source(st, st.sndfile.uri)
+            st.record = fpath
         else:
-            self._set_au_source('')
+            self._set_au_source(st, '')
+            st.record = ''
 
     # Кнопка Воспроизвести
-    def _play(self) -> None:
-        self._au_player._handle_source_change(app.storage.user['media'])
-        self._au_player.play()
+    def _play(self, st: ClientState) -> None:
+        st.au_player._handle_source_change(st.media)
+        st.au_player.play()
 
     # Загрузка аудиозаписи
-    def _download_zdata(self) -> None:
-        fl = io.BytesIO()
-        data, samplerate = soundfile.read(self._sndfile.source)
-        soundfile.write(fl, data, samplerate, format='WAV')
-        fl.seek(0, 0)
-        fname = str(pathlib.Path(self._sndfile.source).stem)
-        ui.download(fl.read(), f'{fname}.wav')
+    def _download_zdata(self, st: ClientState) -> None:
+        if st.record != '':
+            ui.download(f'/download/audio/{self._media.issue(st.record, app.storage.browser["id"])}')
     #endregion
 
-    def detail(self, row: dict) -> None:
+    async def detail(self, st: ClientState, row: dict) -> None:
         rid = row.get('ID радиостанции')
-        self._dialog.clear()
-        with  self._dialog, ui.card().style('width: 90%; height:90%; max-width: none;'):
+        st.dialog.clear()
+        with  st.dialog, ui.card().style('width: 90%; height:90%; max-width: none;'):
             with ui.row().classes('w-full items-end justify-end'):
-                ui.button('Закрыть', on_click=self.close_dlg)
-            with ui.scroll_area().classes('w-full h-full'):
-                ui.table.from_pandas(self.getdetail(int(rid), int(self._sl_year.value), self._month2num(self._sl_month.value))).classes('w-full')
-            self._dialog.open()
-
-    def close_dlg(self) -> None:
-        self._dialog.close()
-        self._dialog.clear()
-        with  self._dialog, ui.card().style('width: 90%; height:90%; max-width: none;'):
+                ui.button('Закрыть', on_click=lambda: self.close_dlg(st))
+            with ui.scroll_area().classes('w-full h-full') as area:
+                ui.spinner(size='lg').classes('mx-auto')
+            st.dialog.open()
+        data = await self.agetdetail(int(rid), int(st.sl_year.value), self._month2num(st.sl_month.value), st.role)
+        area.clear()
+        with area:
+            PagedTable(data, '#', self._rows_per_page, metrics=self._metrics).table.classes('w-full')
+
+    def close_dlg(self, st: ClientState) -> None:
+        st.dialog.close()
+        st.dialog.clear()
+        with  st.dialog, ui.card().style('width: 90%; height:90%; max-width: none;'):
             with ui.row().classes('w-full items-end justify-end'):
-                ui.button('Закрыть', on_click= self._dialog.close)
+                ui.button('Закрыть', on_click= st.dialog.close)
 
     #region Обработчики редиректов UI
     # Основная страница приложения
-    def _uipg_main(self) -> None:
-        # Обновляем полномочия пользователя
-        self._role = self._users.get(app.storage.user.get('username')).get("role")
-
-        # Готовим начальные данные
-        years = self._db_mysql_get_years()
-        months = self._db_mysql_get_months(years[-1], False)
-        groups = self._filter_groups(self._db_pgsql_get_group_names())
-        self._sdata = self.getstat(years[-1], self._month2num(months[-1]))
+    async def _uipg_main(self, client: Client) -> None:
+        # Состояние страницы этого клиента
+        st = ClientState(app.storage.user.get('username'), self._users.get(app.storage.user.get('username')).get("role"), self._media)
 
         # Кнопка выхода
         with ui.row().classes('w-full items-end justify-end'):
+            st.lb_health = ui.label('').classes('h-8 text-negative')
+            ui.timer(self._options.get('health', {}).get('retry', 5), lambda: self._show_health(st))
             ui.label(app.storage.user.get('username')).classes('h-8')
             ui.button(on_click=lambda: (app.storage.user.clear(), ui.navigate.to('/login')), icon='logout').classes('h-6')
 
             # Панели
-            with ui.tabs().classes('w-full') as self._tabs:
-                self._tab1 = ui.tab('Статистика')
-                if self._role != "user":
-                    self._tab2 = ui.tab('Звукозапись')
-
-        with ui.tab_panels(self._tabs, value=self._tab1).classes('w-full'):
-            with ui.tab_panel(self._tab1):
-                self._cont_t1 = ui.row().classes('w-full items-end')
-            if self._role != "user":
-                with ui.tab_panel(self._tab2):
-                    self._cont_t2 = ui.row().classes('w-full items-end')
-
-        with self._cont_t1:
-            self._sl_month = ui.select(months, on_change=self._change_month, value=months[-1])
-            self._sl_year = ui.select(years, on_change=self._change_year, value=years[-1])
-            self._sl_group = ui.select(groups, on_change=self._change_group, value=groups[-1])
-            self._bt_download = ui.button('Скачать', on_click=self._download_data, icon='download')
+            with ui.tabs(on_change=lambda e: self._open_tab(st, e.value)).classes('w-full') as st.tabs:
+                st.tab1 = ui.tab('Статистика')
+                if st.role != "user":
+                    st.tab2 = ui.tab('Звукозапись')
+                st.tab3 = ui.tab('Нагрузка')
+
+        with ui.tab_panels(st.tabs, value=st.tab1).classes('w-full'):
+            with ui.tab_panel(st.tab1):
+                st.cont_t1 = ui.row().classes('w-full items-end')
+            if st.role != "user":
+                with ui.tab_panel(st.tab2):
+                    st.cont_t2 = ui.row().classes('w-full items-end')
+            with ui.tab_panel(st.tab3):
+                st.cont_t3 = ui.row().classes('w-full items-end')
+
+        # Каркас вкладки статистики, данные подгружаются после отправки страницы
+        with st.cont_t1:
+            st.sl_month = ui.select([], on_change=lambda: self._change_month(st))
+            st.sl_year = ui.select([], on_change=lambda: self._change_year(st))
+            st.sl_group = ui.select(['Все группы'], on_change=lambda: self._change_group(st), value='Все группы')
+            st.bt_download = ui.button('Скачать', on_click=lambda: self._download_data(st), icon='download')
             ui.separator()
-            self._tb_data = ui.table.from_pandas(self._sdata).classes('w-full')
-            self._tb_data.add_slot('body-cell', r"""
-                <q-td :props="props" @dblclick="$parent.$emit('cell_dblclick', props)">
-                    {{ props.value }}
-                </q-td>
-                """)
-            self._tb_data.on('cell_dblclick', lambda msg: self.detail(msg.args.get('row')))
+        self._stat_table(st, st.sdata)
+        st.tb_data.props('loading')
+
+        with st.cont_t1:
+            with ui.dialog() as st.dialog, ui.card().classes('w-90'):
+                ui.button('Закрыть', on_click=st.dialog.close)
+
+        st.sl_month.classes('w-[23%] h-11 mx-auto')
+        st.sl_year.classes('w-[23%] h-11 mx-auto')
+        st.sl_group.classes('w-[23%] h-11 mx-auto')
+        st.bt_download.classes('w-[23%] h-9 flex-auto')
+        # Выгрузка доступна после загрузки статистики за первый месяц
+        st.bt_download.disable()
+
+        # Каркас вкладки звукозаписи, записи загружаются при первом открытии вкладки
+        if st.role != "user":
+            with st.cont_t2:
+                st.in_from, st.dt_from = self._date_input('С', self._today())
+                st.in_tfrom = ui.input('Время с', value='00:00').props('mask="##:##"')
+                st.in_to, st.dt_to = self._date_input('По', self._today())
+                st.in_tto = ui.input('Время по', value='23:59').props('mask="##:##"')
+                st.in_caller = ui.input('ID радиостанции').props('clearable').on('keydown.enter', lambda: self._search_records(st))
+                st.in_name = ui.input('Должность').props('clearable').on('keydown.enter', lambda: self._search_records(st))
+
+                st.au_player = ui.audio('', autoplay=True).classes('hidden')
+                st.bt_zsearch = ui.button('Найти', on_click=lambda: self._search_records(st), icon='search')
+                st.bt_zmore = ui.button('Еще', on_click=lambda: self._search_records(st, True), icon='expand_more')
+                st.bt_zmore.disable()
+                st.bt_zplay = ui.button('Воспроизвести', on_click=lambda: self._play(st), icon='arrow_right')
+                st.bt_zdownload = ui.button('Скачать', on_click=lambda: self._download_zdata(st), icon='download')
+                ui.separator()
+                st.pt_zdata = PagedTable(st.zdata, 'id', self._rows_per_page, search=True, metrics=self._metrics, selection='single', on_select=lambda e: self._row_select(st, e),
+                                            labels={'id': 'ID Такт ПРО', 'caller': 'ID радиостанции', 'name': 'Должность', 'datetimestart': 'Начало сеанса', 'datetimeend': 'Конец сеанса',
+                                                    'duration': 'Длительность (c)', 'wave': 'Осциллограмма', 'status': 'Состояние'})
+                st.tb_zdata = st.pt_zdata.table.classes('w-full')
+
+            for inp in (st.in_from, st.in_tfrom, st.in_to, st.in_tto, st.in_caller, st.in_name):
+                inp.classes('w-[15%] h-11 mx-auto')
+            for btn in (st.bt_zsearch, st.bt_zmore, st.bt_zplay, st.bt_zdownload):
+                btn.classes('w-[23%] h-9 flex-auto')
+            self._set_au_source(st, '')
+
+        # Каркас вкладки нагрузки, данные загружаются при первом открытии вкладки
+        with st.cont_t3:
+            st.sl_lmonth = ui.select([], on_change=lambda: self._change_load(st))
+            st.sl_lyear = ui.select([], on_change=lambda: self._change_load_year(st))
+            st.sl_metric = ui.select({'count': 'Звонков', 'airtime': 'Эфир (ч)', 'peak': 'Пик одновременных'}, value='count', on_change=lambda: self._show_load(st))
+            ui.separator()
+            st.ch_load = ui.echart({'tooltip': {'position': 'top'}, 'grid': {'top': 10, 'bottom': 70, 'left': 40, 'right': 10},
+                                    'xAxis': {'type': 'category', 'data': [f'{hour:02d}' for hour in range(24)], 'splitArea': {'show': True}},
+                                    'yAxis': {'type': 'category', 'data': ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс'], 'inverse': True, 'splitArea': {'show': True}},
+                                    'visualMap': {'min': 0, 'max': 1, 'calculable': True, 'orient': 'horizontal', 'left': 'center', 'bottom': 0},
+                                    'series': [{'type': 'heatmap', 'data': [], 'label': {'show': False}}]}).classes('w-full h-80')
+            st.pt_load = PagedTable(pandas.DataFrame([]), 'Группа', self._rows_per_page, metrics=self._metrics)
+            st.tb_load = st.pt_load.table.classes('w-full')
+
+        st.sl_lmonth.classes('w-[30%] h-11 mx-auto')
+        st.sl_lyear.classes('w-[30%] h-11 mx-auto')
+        st.sl_metric.classes('w-[30%] h-11 mx-auto')
+
+        # Страница уже у клиента, независимые данные загружаем параллельно
+        await client.connected()
+        await asyncio.gather(self._load_years(st), self._load_groups(st))
+
+    # Выдача выбранной на странице аудиозаписи по ссылке, выданной этой странице
+    async def _rt_audio(self, token: str, request: Request) -> Response:
+        fpath = self._media.resolve(token, app.storage.browser.get('id', ''))
+        if not app.storage.user.get('authenticated', False) or fpath is None:
+            return Response(status_code=404)
+        stream = await self._run(self._audio_stream, fpath, True)
+        return self._metrics.stream('download_audio', stream.response(request, f'{pathlib.Path(fpath).stem}.wav'))
+
+    # Выдача готового файла выгрузки
+    async def _rt_export(self, job: str) -> Response:
+        res = self._exports.result(job, app.storage.browser.get('id', ''))
+        if res is None:
+            return Response(status_code=404)
+        self._metrics.add('dmrapp_sent_bytes_total', {'op': 'download_export'}, os.path.getsize(res[0]))
+        return FileResponse(res[0], filename=res[1])
+
+    # Выдача аудиозаписи плееру по ссылке
+    async def _rt_media(self, token: str, request: Request) -> Response:
+        fpath = self._media.resolve(token, app.storage.browser.get('id', ''))
+        if fpath is None:
+            return Response(status_code=404)
+        stream = await self._run(self._audio_stream, fpath, False)
+        return self._metrics.stream('media', stream.response(request, os.path.basename(fpath), False))
+
+    # Нагрузка на каналы за месяц или год
+    async def _rt_load(self, year: int, month: Optional[int] = None) -> Union[dict, Response]:
+        if not app.storage.user.get('authenticated', False):
+            return Response(status_code=403)
+        role = self._users.get(app.storage.user.get('username'), {}).get('role', 'user')
+        data = await self.agetload(year, month, role)
+        res = {name: data[name].to_numpy().tolist() for name in ('count', 'airtime', 'peak')}
+        res['groups'] = data['groups'].to_dict('records')
+        return res
 
-            with ui.dialog() as self._dialog, ui.card().classes('w-90'):
-                ui.button('Закрыть', on_click=self._dialog.close)
+    # Показатели работы приложения для Prometheus, доступны с разрешенных адресов и администратору
+    async def _rt_metrics(self, request: Request) -> Response:
+        if request.client is None or request.client.host not in self._metrics_allow:
+            if self._users.get(app.storage.user.get('username'), {}).get('role') != 'admin':
+                return Response(status_code=403)
+        return Response(self._metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
 
-        self._sl_month.classes('w-[23%] h-11 mx-auto')
-        self._sl_year.classes('w-[23%] h-11 mx-auto')
-        self._sl_group.classes('w-[23%] h-11 mx-auto')
-        self._bt_download.classes('w-[23%] h-9 flex-auto')
+    # Состояние БД
+    async def _rt_health(self) -> Union[dict, Response]:
+        if not app.storage.user.get('authenticated', False):
+            return Response(status_code=403)
+        return self._health.status
 
-        if self._role == "user":
-            return
+    # Готовность к работе: 200 после прогрева кэшей, до этого 503
+    async def _rt_ready(self) -> Response:
+        return Response(json.dumps(self._warmup), status_code=200 if self._warmup['ready'] else 503, media_type='application/json')
 
-        with self._cont_t2:
-            self._in_date = ui.input('Дата', value=self._today(), on_change=self._change_date)
-            with self._in_date as date:
-                with date.add_slot('append'):
-                    ui.icon('edit_calendar').on('click', lambda: menu.open()).classes('cursor-pointer')
-                self._mn_date = ui.menu()
-                self._mn_date.props(remove='auto-close')
-                with self._mn_date as menu:
-                    ui.date(mask='DD.MM.YYYY').props(add='no-unset').props(f''':options="date => date >= '{self._minday()}' && date <= '{self._maxday()}'"''').bind_value(self._in_date)
-
-            self._au_player = ui.audio('', autoplay=True).classes('hidden')
-            self._bt_zplay = ui.button('Воспроизвести', on_click=self._play, icon='arrow_right')
-            self._bt_zdownload = ui.button('Скачать', on_click=self._download_zdata, icon='download')
-            ui.separator()
-            self._tb_zdata = ui.table.from_pandas(self._zdata, selection='single', on_select=self._row_select).classes('w-full')
-            self._change_date()
+    # Ответ API при недоступной БД
+    async def _rt_backend_down(self, request: Request, err: BackendDown) -> Response:
+        return Response(str(err), status_code=503, media_type='text/plain; charset=utf-8')
 
-        self._in_date.classes('w-[30%] h-11 mx-auto')
-        self._bt_zplay.classes('w-[30%] h-9 flex-auto')
-        self._bt_zdownload.classes('w-[30%] h-9 flex-auto')
-        self._set_au_source('')
+    # Счетчики кэша аудиозаписей
+    async def _rt_audiocache(self) -> Union[dict, Response]:
+        if not app.storage.user.get('authenticated', False):
+            return Response(status_code=403)
+        return self._audiocache.stats
 
     # Страница входа
     def _uipg_login(self) -> Optional[RedirectResponse]:
         def try_login() -> None:
             if self._users.get(username.value).get("pass") == password.value:
                 app.storage.user.update({'username': username.value, 'authenticated': True})
-                self._role = self._users.get(username.value).get("role")
                 ui.navigate.to(app.storage.user.get('referrer_path', '/'))
             else:
                 ui.notify('Неверное имя пользователя или пароль', color='negative')
@@ -632,12 +2157,43 @@ class DMRApp():
     #endregion
 
 def main():
+    args = argparse.ArgumentParser(description='Радиосвязь DMR')
+    args.add_argument('--rebuild-rollup', action='store_true', help='перестроить локальное хранилище итогов и выйти')
+    args.add_argument('--instance', type=int, help='номер процесса при запуске нескольких процессов')
+    args = args.parse_args()
+
     config = {}
     with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dmrapp.json'), 'r', encoding='utf-8') as file:
         config = json.load(file)
 
-    App = DMRApp("postgresql+psycopg2://postgres:" + config['dbpass'] + "@127.0.0.1:5432/postgres", "mysql+mysqldb://root:" + config['dbpass'] + "@127.0.0.1:3306/xpt_db", config['users'], config['recdir'])
-    App.start()
+    if args.rebuild_rollup:
+        localdb = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.get('localdb', 'dmrapp.db'))
+        catalog = TableCatalog(localdb)
+        with create_engine("mysql+mysqldb://root:" + config['dbpass'] + "@127.0.0.1:3306/xpt_db").connect() as conn:
+            catalog.refresh(conn)
+            StatRollup(localdb).rebuild(conn, catalog.names())
+        SharedStore(localdb).delete('stat:%')
+        return
+
+    # Несколько процессов запускаются на соседних портах за обратным прокси, процесс 0 выполняет фоновые задачи
+    # Хранилище пользователей NiceGUI должно быть общим для всех процессов, поэтому без redis запуск невозможен
+    iopts = config.get('instances', {})
+    if iopts.get('count', 1) > 1 and args.instance is None:
+        if not iopts.get('redis'):
+            sys.exit('instances.count > 1 требует instances.redis для общего хранилища пользователей')
+        env = dict(os.environ, NICEGUI_REDIS_URL=iopts['redis'])
+        procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--instance', str(i)], env=env) for i in range(iopts['count'])]
+        try:
+            for proc in procs:
+                proc.wait()
+        except KeyboardInterrupt:
+            for proc in procs:
+                proc.terminate()
+        return
+
+    App = DMRApp("postgresql+psycopg2://postgres:" + config['dbpass'] + "@127.0.0.1:5432/postgres", "mysql+mysqldb://root:" + config['dbpass'] + "@127.0.0.1:3306/xpt_db", config['users'], config['recdir'], config,
+                 args.instance in (None, 0))
+    App.start(2606 if args.instance is None else iopts.get('port', 2611) + args.instance)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file